@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the vectorized calc_fwhm()/calc_fwhm_many() against the original loop-based implementation."""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from databroker_extractor.common.math import calc_fwhm, calc_fwhm_many
+
+
+def calc_fwhm_loop(x, y, shift=0.5):
+    """The original (loop-based) implementation of calc_fwhm(), used as a reference."""
+    y = (y - np.min(y)) / (np.max(y) - np.min(y)) - shift
+    positive = y[0] > 0
+    list_of_roots = []
+    for i in range(len(y)):
+        current_positive = y[i] > 0
+        if current_positive != positive:
+            list_of_roots.append(x[i - 1] + (x[i] - x[i - 1]) / (abs(y[i]) + abs(y[i - 1])) * abs(y[i - 1]))
+            positive = not positive
+    if len(list_of_roots) < 2:
+        raise Exception('Number of roots is less than 2!')
+    return {
+        'fwhm': abs(list_of_roots[-1] - list_of_roots[0]),
+        'x_range': list_of_roots,
+    }
+
+
+def make_scans(num_scans, num_points, seed=0):
+    rs = np.random.RandomState(seed)
+    x_list = []
+    y_list = []
+    for i in range(num_scans):
+        n = num_points - rs.randint(0, num_points // 10 + 1)  # ragged scans
+        x = np.linspace(8000, 8100, n)
+        center = rs.uniform(8040, 8060)
+        y = np.exp(-(x - center) ** 2 / (2 * rs.uniform(2, 10) ** 2)) + rs.normal(0, 0.01, n)
+        x_list.append(x)
+        y_list.append(y)
+    return x_list, y_list
+
+
+def run(num_scans=100, num_points=10000, number=3):
+    x_list, y_list = make_scans(num_scans, num_points)
+
+    # Check that the results are identical:
+    reference = [calc_fwhm_loop(x, y) for x, y in zip(x_list, y_list)]
+    single = [calc_fwhm(x, y) for x, y in zip(x_list, y_list)]
+    many = calc_fwhm_many(x_list, y_list)
+    for r, s, m in zip(reference, single, many):
+        assert r['fwhm'] == s['fwhm'] == m['fwhm'], (r['fwhm'], s['fwhm'], m['fwhm'])
+        assert r['x_range'] == s['x_range'] == m['x_range']
+
+    timings = {
+        'loop': lambda: [calc_fwhm_loop(x, y) for x, y in zip(x_list, y_list)],
+        'calc_fwhm': lambda: [calc_fwhm(x, y) for x, y in zip(x_list, y_list)],
+        'calc_fwhm_many': lambda: calc_fwhm_many(x_list, y_list),
+    }
+    results = {}
+    for name, func in timings.items():
+        results[name] = min(timeit.repeat(func, number=1, repeat=number))
+    print('{} scans x ~{} points (best of {}):'.format(num_scans, num_points, number))
+    for name, t in results.items():
+        print('    {:<15} {:10.4f} s  (x{:.1f})'.format(name, t, results['loop'] / t))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark calc_fwhm implementations')
+    parser.add_argument('-n', '--num-scans', dest='num_scans', default=100, type=int, help='number of scans')
+    parser.add_argument('-p', '--num-points', dest='num_points', default=10000, type=int, help='points per scan')
+    parser.add_argument('-r', '--repeat', dest='repeat', default=3, type=int, help='number of repetitions')
+    args = parser.parse_args()
+    run(num_scans=args.num_scans, num_points=args.num_points, number=args.repeat)
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""A synthetic in-memory broker for the offline benchmarks (see pipeline.py)."""
+
+import random
+import re
+import time
+import uuid
+
+import numpy as np
+
+import databroker_extractor.common.databroker as c_db
+
+# Columns of typical scans at the beamlines (the x/y labels match the default labels in beamlines.json):
+BEAMLINE_COLUMNS = {
+    'SMI': {
+        'x_label': 'dcm_bragg',
+        'y_label': 'VFMcamroi1',
+        'x_range': (11.8, 12.2),
+        'columns': ['dcm_bragg', 'dcm_bragg_user_setpoint', 'VFMcamroi1', 'VFMcamroi2', 'VFMcamroi3', 'VFMcamroi4',
+                    'VFMcam_stats1_total', 'ring_current'],
+    },
+    'CHX': {
+        'x_label': 'dcm_b',
+        'y_label': 'elm_sum_all',
+        'x_range': (10.9, 11.3),
+        'columns': ['dcm_b', 'dcm_b_user_setpoint', 'elm_sum_all', 'elm_sum_diag1', 'elm_sum_diag2',
+                    'xray_eye1_stats1_total', 'xray_eye3_stats1_total', 'ring_current'],
+    },
+    'SRX': {
+        'x_label': 'energy_bragg',
+        'y_label': 'bpmAD_stats3_total',
+        'x_range': (13.4, 13.8),
+        'columns': ['energy_bragg', 'energy_energy', 'energy_u_gap', 'bpmAD_stats1_total', 'bpmAD_stats2_total',
+                    'bpmAD_stats3_total', 'bpmAD_stats4_total', 'ring_current'],
+    },
+}
+
+
+class FakeHeader(c_db.DetachedHeader):
+    """A header of a synthetic scan with the .start/.stop/.descriptors/.fields()/.table() surface of databroker."""
+
+    def __init__(self, db, start, fields):
+        super(FakeHeader, self).__init__(start, fields)
+        self._db = db
+        self.stop = c_db.Document(run_start=start['uid'], time=start['time'] + 60, exit_status='success',
+                                  uid=str(uuid.UUID(int=db.random.getrandbits(128))))
+        self.descriptors = [c_db.Document(run_start=start['uid'], name='primary',
+                                          data_keys={f: {'dtype': 'number', 'shape': [], 'source': 'PV:{}'.format(f)}
+                                                     for f in fields})]
+
+    def table(self, fields=None):
+        import pandas as pd
+
+        self._db.sleep(self._db.table_latency)
+        data = self._db.make_data(self.start)
+        if fields is not None:
+            data = {f: data[f] for f in ['time'] + [f for f in fields if f != 'time']}
+        n = len(data['time'])
+        return pd.DataFrame(data, index=pd.Index(np.arange(1, n + 1), name='seq_num'))
+
+
+class FakeBroker(object):
+    """An in-memory broker with synthetic scans, mimicking db[scan_id], db(**query) and db.get_events().
+
+    The scans of the beamline (see BEAMLINE_COLUMNS) are peaks with random centers and widths along the x column; the
+    data are generated deterministically from the seed and the scan id on each request, like a remote database would
+    serve them. The latencies emulate the round trips to the metadatastore (per query) and to the event/filestore
+    data (per table or per event stream).
+
+    :param beamline: beamline name (SMI, CHX or SRX).
+    :param num_scans: number of scans.
+    :param num_points: number of events per scan.
+    :param first_scan_id: scan id of the first scan.
+    :param latency: delay of each metadata query [s].
+    :param table_latency: delay of each table or event stream request [s].
+    :param seed: seed of the random generator.
+    """
+
+    def __init__(self, beamline='SMI', num_scans=100, num_points=500, first_scan_id=1, latency=0.0,
+                 table_latency=0.0, seed=0):
+        beamline = beamline.upper()
+        if beamline not in BEAMLINE_COLUMNS:
+            raise ValueError('{}: unknown beamline, available beamlines: {}'.format(
+                beamline, ', '.join(sorted(BEAMLINE_COLUMNS))))
+        self.beamline = beamline
+        self.config = BEAMLINE_COLUMNS[beamline]
+        self.num_points = num_points
+        self.latency = latency
+        self.table_latency = table_latency
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.headers = []
+        for i in range(num_scans):
+            start = c_db.Document(
+                uid=str(uuid.UUID(int=self.random.getrandbits(128))),
+                scan_id=first_scan_id + i,
+                beamline_id=beamline,
+                time=1.5e9 + 120 * i,
+                plan_name='scan',
+                motors=[self.config['x_label']],
+                detectors=[self.config['y_label']],
+            )
+            self.headers.append(FakeHeader(self, start, ['time'] + self.config['columns']))
+        self.num_queries = 0
+
+    def __getitem__(self, scan_id):
+        self.sleep(self.latency)
+        if isinstance(scan_id, str):
+            found = [h for h in self.headers if h.start.uid.startswith(scan_id)]
+            if len(found) > 1:
+                raise ValueError('{}: ambiguous uid prefix'.format(scan_id))
+        elif scan_id < 0:
+            found = self.headers[scan_id:][:1] if -scan_id <= len(self.headers) else []
+        else:
+            found = [h for h in self.headers if h.start.scan_id == scan_id][-1:]
+        if not found:
+            raise ValueError('{}: no such scan found'.format(scan_id))
+        return found[0]
+
+    def __call__(self, start_time=None, **query):
+        """Find headers with a subset of the Mongo-style queries used by common.databroker and common.store."""
+        self.sleep(self.latency)
+        return [h for h in self.headers
+                if (start_time is None or h.start.time >= start_time) and
+                all(_match(h.start.get(k), v) for k, v in query.items())]
+
+    def get_events(self, header, fields=None, fill=False):
+        data = header.table(fields=fields)
+        for seq_num, row in zip(data.index, data.to_dict('records')):
+            t = row.pop('time')
+            yield {'seq_num': int(seq_num), 'time': t, 'data': row, 'descriptor': header.descriptors[0]}
+
+    def make_data(self, start):
+        """Generate the columns of a scan.
+
+        :param start: the run-start document of the scan.
+        :return: a dict {column: numpy array}.
+        """
+        rs = np.random.RandomState([self.seed, start['scan_id']])
+        n = self.num_points
+        x_min, x_max = self.config['x_range']
+        x = np.linspace(x_min, x_max, n)
+        center = rs.uniform(x_min + 0.3 * (x_max - x_min), x_max - 0.3 * (x_max - x_min))
+        width = rs.uniform(0.01, 0.05) * (x_max - x_min)
+        data = {'time': start['time'] + np.arange(n) * 0.1}
+        for i, column in enumerate(self.config['columns']):
+            if i == 0:
+                data[column] = x
+            elif column == 'ring_current':
+                data[column] = 400 + rs.normal(0, 0.1, n)
+            elif column.endswith('setpoint'):
+                data[column] = x
+            else:
+                peak = np.exp(-(x - center) ** 2 / (2 * width ** 2))
+                data[column] = 1e5 * (peak + rs.normal(0, 0.01, n)) / (i + 1)
+        return data
+
+    def sleep(self, delay):
+        self.num_queries += 1
+        if delay:
+            time.sleep(delay)
+
+
+def _match(value, condition):
+    if not isinstance(condition, dict):
+        return value == condition
+    for op, arg in condition.items():
+        if op == '$in':
+            if value not in arg:
+                return False
+        elif op == '$regex':
+            if value is None or not re.search(arg, value):
+                return False
+        else:
+            raise ValueError('{}: the query operator is not supported'.format(op))
+    return True
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Offline benchmarks of the extractor pipeline on a synthetic in-memory broker (see fake_broker.py).
+
+It covers read_scans(), plot_scans() (per-PNG cost of the batch rendering, with and without reusing the figures),
+save_data() for the supported formats, bragg_to_energy()/bragg_to_energy_many(), calc_fwhm()/calc_fwhm_many() (also
+on 20 scans of 10k points) and calc_dist(). The files are written to a temporary directory. The latencies of the
+broker emulate the round trips to a remote (e.g., tunneled) database.
+
+The run fails if an optimized path is slower than the path it replaces (see FASTER_THAN), if a benchmark is slower
+than in a baseline saved by a previous run (--save-baseline/--baseline) by more than the tolerance, or if the streamed
+csv/text files differ from the files written from the whole tables (see check_stream_output()).
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+
+import databroker_extractor.common.databroker as c_db
+import databroker_extractor.common.energy as c_energy
+import databroker_extractor.common.io as c_io
+import databroker_extractor.common.math as c_math
+import databroker_extractor.common.plot as c_plot
+from fake_broker import FakeBroker
+
+SAVE_EXTENSIONS = ('dat', 'csv', 'h5', 'parquet', 'feather', 'npz')
+
+# Pairs of (optimized, reference) benchmarks, the optimized path must not be slower than the reference one:
+FASTER_THAN = (
+    ('read_scans (warm cache)', 'read_scans (cold cache)'),
+    ('plot_scans (per PNG, reused figure)', 'plot_scans (per PNG, new figure)'),
+    ('bragg_to_energy_many', 'bragg_to_energy'),
+    ('calc_fwhm_many', 'calc_fwhm'),
+    ('calc_fwhm_many (long scans)', 'calc_fwhm (long scans)'),
+    ('calc_dist (refine)', 'calc_dist (grid)'),
+)
+
+
+def best_time(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_read_scans(db, scan_ids, repeat=3):
+    x_label = db.config['x_label']
+    y_label = db.config['y_label']
+
+    def cold():
+        c_db.clear_cache()
+        c_db.read_scans(db, scan_ids=scan_ids, x_label=x_label, y_label=y_label)
+
+    def warm():
+        c_db.read_scans(db, scan_ids=scan_ids, x_label=x_label, y_label=y_label)
+
+    return {
+        'read_scans (cold cache)': best_time(cold, repeat),
+        'read_scans (warm cache)': best_time(warm, repeat),
+    }
+
+
+def bench_plot_scans(db, scans, repeat=3):
+    plot_kwargs = {'x_label': db.config['x_label'], 'y_label': db.config['y_label'], 'show': False, 'timestamp': None}
+
+    def batch():
+        for scan in scans:
+            c_plot.plot_scans(None, scan_ids=[scan['scan_id']], scans=[scan], **plot_kwargs)
+
+    def new_figures():
+        for scan in scans:
+            c_plot._batch_figures.figures = {}
+            c_plot.plot_scans(None, scan_ids=[scan['scan_id']], scans=[scan], **plot_kwargs)
+
+    return {
+        'plot_scans (per PNG, reused figure)': best_time(batch, repeat) / len(scans),
+        'plot_scans (per PNG, new figure)': best_time(new_figures, repeat) / len(scans),
+    }
+
+
+def bench_save_data(scans, repeat=3):
+    results = {}
+    for extension in SAVE_EXTENSIONS:
+        def save():
+            for scan in scans:
+                c_io.save_data(None, scan_id=scan['scan_id'], scan=scan, extension=extension)
+
+        try:
+            results['save_data ({})'.format(extension)] = best_time(save, repeat)
+        except ImportError as e:
+            print('    Skipped save_data ({}): {}'.format(extension, e))
+    return results
+
+
+def bench_bragg_to_energy(scans, repeat=3):
+    x_list = [scan['x'] for scan in scans]
+    return {
+        'bragg_to_energy': best_time(lambda: [c_energy.bragg_to_energy(x) for x in x_list], repeat),
+        'bragg_to_energy_many': best_time(lambda: c_energy.bragg_to_energy_many(x_list), repeat),
+    }
+
+
+def bench_calc_fwhm(scans, repeat=3, suffix=''):
+    x_list = [scan['x'] for scan in scans]
+    y_list = [scan['y'] for scan in scans]
+    return {
+        'calc_fwhm' + suffix: best_time(lambda: [c_math.calc_fwhm(x, y) for x, y in zip(x_list, y_list)], repeat),
+        'calc_fwhm_many' + suffix: best_time(lambda: c_math.calc_fwhm_many(x_list, y_list), repeat),
+    }
+
+
+def long_scans(beamline='SMI', num_scans=20, num_points=10000):
+    """Make x/y values of long scans (the typical size of the scans in the FWHM trends), without the broker."""
+    db = FakeBroker(beamline=beamline, num_scans=num_scans, num_points=num_points)
+    scans = []
+    for h in db.headers:
+        data = db.make_data(h.start)
+        scans.append({'x': data[db.config['x_label']], 'y': data[db.config['y_label']]})
+    return scans
+
+
+def bench_calc_dist(num_points=2000, num_shifts=10001, repeat=3):
+    try:
+        from databroker_extractor.beamlines.compare_curves import calc_dist
+    except ImportError as e:
+        print('    Skipped calc_dist: {}'.format(e))
+        return {}
+    x_exp = np.linspace(8000, 8100, num_points)
+    y_exp = np.exp(-(x_exp - 8052) ** 2 / (2 * 4 ** 2))
+    x_calc = np.linspace(7990, 8110, 2 * num_points)
+    y_calc = 5 * np.exp(-(x_calc - 8047) ** 2 / (2 * 5 ** 2))
+    return {
+        'calc_dist ({})'.format(method): best_time(
+            lambda: calc_dist(x_calc, y_calc.copy(), x_exp, y_exp, num_shifts=num_shifts, method=method), repeat)
+        for method in ('grid', 'refine')
+    }
+
+
+def check_stream_output(scans, page_size=37):
+    """Check that the streamed csv and text files are byte-identical to the files written from the whole tables.
+
+    :param scans: a list of dicts returned by read_single_scan().
+    :param page_size: number of rows per page of the stream.
+    :return: a list of the failures.
+    """
+    failures = []
+    for scan in scans:
+        data = scan['data']
+        pages = [data.iloc[i:i + page_size] for i in range(0, len(data), page_size)]
+        for extension in ('dat', 'csv'):
+            for index in (False, True):
+                whole = 'whole.{}'.format(extension)
+                streamed = 'streamed.{}'.format(extension)
+                c_io.save_data_pandas(whole, data, columns=None, index=index)
+                c_io.save_data_stream(streamed, pages, index=index)
+                with open(whole, 'rb') as f1, open(streamed, 'rb') as f2:
+                    if f1.read() != f2.read():
+                        failures.append('scan {}: the streamed {} file (index={}) differs from the whole one'.format(
+                            scan['scan_id'], extension, index))
+    return failures
+
+
+def check(results, baseline=None, tolerance=0.25):
+    """Compare the timings with the expected relations (see FASTER_THAN) and with the baseline.
+
+    :param results: a dict {benchmark: time [s]}.
+    :param baseline: a dict {benchmark: time [s]} of a previous run.
+    :param tolerance: allowed relative slowdown.
+    :return: a list of the failures.
+    """
+    failures = []
+    for fast, slow in FASTER_THAN:
+        if fast in results and slow in results and results[fast] > results[slow] * (1 + tolerance):
+            failures.append('{} ({:.4f} s) is slower than {} ({:.4f} s)'.format(fast, results[fast], slow,
+                                                                               results[slow]))
+    for name, t in sorted((baseline or {}).items()):
+        if name in results and results[name] > t * (1 + tolerance):
+            failures.append('{}: {:.4f} s, {:.0f}% slower than the baseline ({:.4f} s)'.format(
+                name, results[name], (results[name] / t - 1) * 100, t))
+    return failures
+
+
+def run(beamline='SMI', num_scans=50, num_points=500, latency=0.0, table_latency=0.0, repeat=3, baseline=None,
+        save_baseline=None, tolerance=0.25):
+    import matplotlib
+    matplotlib.use('Agg')
+
+    db = FakeBroker(beamline=beamline, num_scans=num_scans, num_points=num_points, latency=latency,
+                    table_latency=table_latency)
+    scan_ids = [h.start.scan_id for h in db.headers]
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp(prefix='databroker_extractor_bench_')
+    try:
+        os.chdir(tmp_dir)
+        results = bench_read_scans(db, scan_ids, repeat)
+        scans = c_db.read_scans(db, scan_ids=scan_ids, x_label=db.config['x_label'],
+                                y_label=db.config['y_label'])['scans']
+        results.update(bench_plot_scans(db, scans, repeat))
+        results.update(bench_save_data(scans, repeat))
+        results.update(bench_bragg_to_energy(scans, repeat))
+        results.update(bench_calc_fwhm(scans, repeat))
+        results.update(bench_calc_fwhm(long_scans(beamline), repeat, suffix=' (long scans)'))
+        results.update(bench_calc_dist(repeat=repeat))
+        failures = check_stream_output(scans[:5])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+
+    print('{}: {} scans x {} points, latency {} s, table latency {} s (best of {}):'.format(
+        beamline, num_scans, num_points, latency, table_latency, repeat))
+    for name, t in results.items():
+        print('    {:<40} {:10.4f} s'.format(name, t))
+
+    if save_baseline:
+        with open(save_baseline, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        print('Saved the baseline to {}'.format(save_baseline))
+    if baseline:
+        with open(baseline) as f:
+            baseline = json.load(f)
+    failures += check(results, baseline=baseline, tolerance=tolerance)
+    assert not failures, 'Failed checks:\n    {}'.format('\n    '.join(failures))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the extractor pipeline on a synthetic broker')
+    parser.add_argument('-b', '--beamline', dest='beamline', default='SMI', help='beamline (SMI, CHX or SRX)')
+    parser.add_argument('-n', '--num-scans', dest='num_scans', default=50, type=int, help='number of scans')
+    parser.add_argument('-p', '--num-points', dest='num_points', default=500, type=int, help='points per scan')
+    parser.add_argument('-l', '--latency', dest='latency', default=0.0, type=float,
+                        help='latency of each metadata query [s]')
+    parser.add_argument('-t', '--table-latency', dest='table_latency', default=0.0, type=float,
+                        help='latency of each table request [s]')
+    parser.add_argument('-r', '--repeat', dest='repeat', default=3, type=int, help='number of repetitions')
+    parser.add_argument('--baseline', dest='baseline', default=None,
+                        help='JSON file with the timings of a previous run to compare with')
+    parser.add_argument('--save-baseline', dest='save_baseline', default=None,
+                        help='JSON file to save the timings to (to be used as --baseline later)')
+    parser.add_argument('--tolerance', dest='tolerance', default=0.25, type=float,
+                        help='allowed relative slowdown against the baseline and the reference paths')
+    args = parser.parse_args()
+    run(beamline=args.beamline, num_scans=args.num_scans, num_points=args.num_points, latency=args.latency,
+        table_latency=args.table_latency, repeat=args.repeat, baseline=args.baseline,
+        save_baseline=args.save_baseline, tolerance=args.tolerance)
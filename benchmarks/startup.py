@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Startup benchmark of the databroker-extractor CLI based on `python -X importtime`.
+
+It checks that importing the CLI does not pull the heavy plotting, fitting and databroker backends, and measures the
+wall time of `databroker-extractor --help`.
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+# Modules which must be imported on demand only:
+HEAVY_MODULES = ('matplotlib', 'PIL', 'lmfit', 'scipy', 'pandas', 'databroker', 'filestore', 'metadatastore',
+                 'chxtools')
+
+
+def import_times(module='databroker_extractor.extractor'):
+    """Import the module in a fresh interpreter and parse the output of `-X importtime`.
+
+    :param module: module to import.
+    :return: a dict {module name: cumulative import time [s]}.
+    """
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if p.returncode != 0:
+        raise RuntimeError('Failed to import {}:\n{}'.format(module, p.stderr))
+    times = {}
+    for line in p.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split(':', 1)[1].split('|')
+        times[name.strip()] = int(cumulative) * 1e-6
+    return times
+
+
+def help_time(repeat=3):
+    """Best wall time of `python -m databroker_extractor --help` [s]."""
+    best = None
+    for _ in range(repeat):
+        t = time.time()
+        subprocess.run([sys.executable, '-m', 'databroker_extractor', '--help'], stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, check=True)
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def run(top=10, max_help_time=1.0):
+    times = import_times()
+    heavy = sorted({name.split('.')[0] for name in times} & set(HEAVY_MODULES))
+    print('Import of databroker_extractor.extractor: {:.3f} s'.format(times.get('databroker_extractor.extractor', 0)))
+    print('Slowest imports:')
+    for name, t in sorted(times.items(), key=lambda x: x[1], reverse=True)[:top]:
+        print('    {:<50} {:.3f} s'.format(name, t))
+    t_help = help_time()
+    print('databroker-extractor --help: {:.3f} s'.format(t_help))
+
+    assert not heavy, 'Heavy modules imported at startup: {}'.format(heavy)
+    assert t_help < max_help_time, '--help took {:.3f} s (> {} s)'.format(t_help, max_help_time)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of the databroker-extractor CLI')
+    parser.add_argument('-t', '--top', dest='top', default=10, type=int, help='number of the slowest imports to show')
+    parser.add_argument('-m', '--max-help-time', dest='max_help_time', default=1.0, type=float,
+                        help='maximum allowed wall time of --help [s]')
+    args = parser.parse_args()
+    run(top=args.top, max_help_time=args.max_help_time)
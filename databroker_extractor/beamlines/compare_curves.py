@@ -1,54 +1,91 @@
 import argparse
+import concurrent.futures
+import functools
 import glob
 import os
 
-import chxtools.xfuncs as xf  # from https://github.com/NSLS-II-CHX/chxtools/blob/master/chxtools/xfuncs.py
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import scipy.spatial.distance as spd
 
+from databroker_extractor.common.energy import bragg_to_energy
 from databroker_extractor.common.io import save_data_pandas
 from databroker_extractor.common.math import calc_fwhm
 from databroker_extractor.common.plot import clear_plt
 
 
-def calc_dist(x_calc, y_calc, x_exp, y_exp):
+def calc_dist(x_calc, y_calc, x_exp, y_exp, pct_range=10., num_shifts=10001, method='grid', chunk_size=1000):
     """Calculate cosine distance between experimental and calculated datasets.
 
+    The calculated data are shifted along X by up to +/-pct_range percent of the offset between the peaks of the
+    datasets, and the shift with the minimal cosine distance is selected. All candidate shifts are evaluated as 2D
+    blocks of at most chunk_size shifts at once. The 'grid' method evaluates num_shifts equidistant shifts, the
+    'refine' method evaluates coarse grids around the best shift, until the step of the 'grid' method is reached.
+
     :param x_calc: calculated X values.
     :param y_calc: calculated Y values.
     :param x_exp: experimental X values.
     :param y_exp: experimental Y values.
-    :return: cosine distance and interpolated calculated Y values on the experimental X mesh.
+    :param pct_range: the range of the shifts in percent of the offset between the peaks.
+    :param num_shifts: number of the shifts to evaluate (defines the resolution of the search).
+    :param method: 'grid' or 'refine' (coarse-to-fine search).
+    :param chunk_size: maximum number of shifts evaluated at once (bounds the memory usage).
+    :return: cosine distance, interpolated calculated Y values on the experimental X mesh and the shift.
     """
+    allowed_methods = ('grid', 'refine')
+    if method not in allowed_methods:
+        raise ValueError('{}: not allowed. Allowed values: {}'.format(method, allowed_methods))
+
     # Normalize calculated data on maximum of experimental data:
     y_calc *= y_exp.max() / y_calc.max()
 
     # Calculate shift of the data and shift the calculated data:
     shift = x_exp[y_exp.argmax()] - x_calc[y_calc.argmax()]  # eV
 
-    cosines = []
-    meshes = []
-    shifts = []
-    for pct in np.linspace(-10, 10, 10001):
-        new_shift = shift * (1. + pct / 100.)
-        new_x_calc = x_calc + new_shift
+    x_calc = np.asarray(x_calc, dtype=float)
+    y_calc = np.asarray(y_calc, dtype=float)
+    x_exp = np.asarray(x_exp, dtype=float)
+    y_exp = np.asarray(y_exp, dtype=float)
+
+    if method == 'grid':
+        shifts = shift * (1. + np.linspace(-pct_range, pct_range, num_shifts) / 100.)
+        cosines = _calc_cosines(x_calc, y_calc, x_exp, y_exp, shifts, chunk_size=chunk_size)
+        best_shift = shifts[np.argmin(cosines)]
+    else:
+        best_shift = _refine_shift(x_calc, y_calc, x_exp, y_exp, shift, pct_range=pct_range,
+                                   target_step=2. * pct_range / (num_shifts - 1), chunk_size=chunk_size)
+
+    # Map the calculated data to the experimental mesh for the best shift:
+    y_calc_exp_mesh = np.interp(x_exp, x_calc + best_shift, y_calc)
 
-        # Map the calculated data to the experimental mesh:
-        y_calc_exp_mesh = np.interp(x_exp, new_x_calc, y_calc)
+    return spd.cosine(y_calc_exp_mesh, y_exp), y_calc_exp_mesh, best_shift
 
-        # Measure similarity:
-        cosine = spd.cosine(y_calc_exp_mesh, y_exp)
 
-        cosines.append(cosine)
-        meshes.append(y_calc_exp_mesh)
-        shifts.append(new_shift)
+def _calc_cosines(x_calc, y_calc, x_exp, y_exp, shifts, chunk_size=1000):
+    """Calculate cosine distances for all the shifts, evaluating chunk_size shifts at once."""
+    y_exp_norm = np.linalg.norm(y_exp)
+    cosines = np.empty(len(shifts))
+    for i in range(0, len(shifts), chunk_size):
+        chunk = shifts[i:i + chunk_size]
+        # Shifting the calculated mesh by +shift is the same as shifting the experimental mesh by -shift:
+        meshes = np.interp(x_exp[np.newaxis, :] - chunk[:, np.newaxis], x_calc, y_calc)
+        cosines[i:i + chunk_size] = 1. - meshes.dot(y_exp) / (np.linalg.norm(meshes, axis=1) * y_exp_norm)
+    return cosines
 
-    # Find min cosine and the corresponding mesh:
-    idx = np.argmin(cosines)
 
-    return cosines[idx], meshes[idx], shifts[idx]
+def _refine_shift(x_calc, y_calc, x_exp, y_exp, shift, pct_range, target_step, num_points=101, chunk_size=1000):
+    """Coarse-to-fine search of the best shift: each level zooms in on +/-1 step around the best shift so far."""
+    left, right = -pct_range, pct_range
+    while True:
+        pcts = np.linspace(left, right, num_points)
+        step = pcts[1] - pcts[0]
+        cosines = _calc_cosines(x_calc, y_calc, x_exp, y_exp, shift * (1. + pcts / 100.), chunk_size=chunk_size)
+        best_pct = pcts[np.argmin(cosines)]
+        if step <= target_step:
+            return shift * (1. + best_pct / 100.)
+        left = max(best_pct - step, -pct_range)
+        right = min(best_pct + step, pct_range)
 
 
 def plot_data(exp_file, calc_file, x_exp, y_exp, y_calc_exp_mesh, cosine, precision=6, shift=None,
@@ -58,8 +95,7 @@ def plot_data(exp_file, calc_file, x_exp, y_exp, y_calc_exp_mesh, cosine, precis
     base_calc_file = os.path.basename(calc_file)
     base_exp_file = os.path.basename(exp_file)
 
-    save_fig_file = '{}_{}.png'.format(os.path.splitext(base_exp_file)[0].split('-')[0],
-                                       os.path.splitext(base_calc_file)[0])
+    save_fig_file = '{}.png'.format(_output_basename(exp_file, calc_file))
 
     ax.plot(x_exp, y_calc_exp_mesh,
             label='Calculated data: {} (norm. and interp. to exp.data)'.format(base_calc_file))
@@ -81,6 +117,69 @@ def plot_data(exp_file, calc_file, x_exp, y_exp, y_calc_exp_mesh, cosine, precis
     return save_fig_file
 
 
+def score_calc_file(calc_file, exp_file, x_exp, y_exp, method='grid', plot=True, cache=True):
+    """Read a calculated data file, calculate its cosine distance to the experimental data and save the results.
+
+    :param calc_file: the *.dat file from a SRW simulation.
+    :param exp_file: experimental CSV file from databroker.
+    :param x_exp: experimental X values.
+    :param y_exp: experimental Y values.
+    :param method: method to search the shift of the calculated data (see calc_dist()).
+    :param plot: if to plot the calculated data against the experimental data.
+    :param cache: if to use the binary cache of the calculated data file (see read_calc()).
+    :return: a dict with the energy spread, the cosine distance, the FWHM and the names of the saved files.
+    """
+    x_calc, y_calc, fwhm_calc = read_calc(calc_file=calc_file, cache=cache)
+
+    # Calculate cosine distance:
+    cosine, y_calc_exp_mesh, shift = calc_dist(x_calc=x_calc, y_calc=y_calc, x_exp=x_exp, y_exp=y_exp, method=method)
+
+    # Plot:
+    save_fig_file = None
+    if plot:
+        save_fig_file = plot_data(exp_file=exp_file, calc_file=calc_file, x_exp=x_exp, y_exp=y_exp,
+                                  y_calc_exp_mesh=y_calc_exp_mesh, cosine=cosine, shift=shift)
+
+    # Save data:
+    columns = ['energy', 'intensity_calc', 'intensity_exp']
+    data = pd.DataFrame(np.array([x_exp, y_calc_exp_mesh, y_exp]).T, columns=columns)
+    fname = _output_basename(exp_file, calc_file)
+    file_name_dat = '{}.dat'.format(fname)
+    file_name_csv = '{}.csv'.format(fname)
+    save_data_pandas(file_name_dat, data, columns, index=True, justify='right')
+    data.to_csv(file_name_csv)
+
+    try:
+        ens_value = float(os.path.basename(calc_file).split('_')[4])
+    except:
+        ens_value = -1.
+
+    return {
+        'calc_file': calc_file,
+        'ens': ens_value,
+        'cosine': cosine,
+        'shift': shift,
+        'fwhm_calc': fwhm_calc,
+        'fig_file': save_fig_file,
+        'dat_file': file_name_dat,
+    }
+
+
+def sweep(calc_files, exp_file, x_exp, y_exp, method='grid', plot=True, cache=True, jobs=1):
+    """Score many calculated data files (e.g., an energy spread sweep), optionally in parallel processes.
+
+    :param calc_files: a list of the *.dat files from SRW simulations.
+    :param jobs: number of parallel processes.
+    :return: a list of the results of score_calc_file() in the order of calc_files.
+    """
+    func = functools.partial(score_calc_file, exp_file=exp_file, x_exp=x_exp, y_exp=y_exp, method=method, plot=plot,
+                             cache=cache)
+    if jobs == 1:
+        return [func(calc_file) for calc_file in calc_files]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as executor:
+        return list(executor.map(func, calc_files))
+
+
 def read_exp(exp_file, conversion_factor=1, convert_to_energy=False, material='Si111cryo', d_spacing=None):
     """Read experimental data.
 
@@ -91,30 +190,43 @@ def read_exp(exp_file, conversion_factor=1, convert_to_energy=False, material='S
     exp_data = pd.read_csv(exp_file)
     x_exp = exp_data[x_label]
     if convert_to_energy:
-        x_exp = xf.get_EBragg(material, theta_Bragg=np.abs(x_exp), d_spacing=d_spacing) * 1e3  # keV -> eV
+        x_exp = pd.Series(bragg_to_energy(x_exp, material=material, d_spacing=d_spacing), index=x_exp.index,
+                          name=x_exp.name)  # eV
     y_exp = exp_data[y_label]
     x_exp *= conversion_factor
     fwhm_exp = _calc_fwhm(x_exp, y_exp)
     return x_exp, y_exp, fwhm_exp
 
 
-def read_calc(calc_file, header_rows=10):
+def read_calc(calc_file, header_rows=10, cache=True):
     """Read calculated data
 
+    The header and the data are parsed in a single pass over the file. If cache is True, the parsed arrays are saved
+    next to the file (<calc_file>.npy) and reused while the cache file is newer than the data file.
+
     :param calc_file: the *.dat file from a SRW simulation.
     :param header_rows: number of informational rows in header of the file.
+    :param cache: if to use (and create) the binary cache of the parsed data.
     :return: x and y values.
     """
-    with open(calc_file) as f:
-        content = f.readlines()
-    header = content[:header_rows]
-    eph_init = _parse_header(header[1], data_type=float)
-    eph_fin = _parse_header(header[2], data_type=float)
-    n_points = _parse_header(header[3], data_type=int)
-    x_calc = np.linspace(eph_init, eph_fin, n_points)
-    y_calc = np.loadtxt(calc_file, skiprows=header_rows)
-    assert n_points == len(y_calc), \
-        'Number of points {} does not match the length of the read data {}'.format(len(y_calc), n_points)
+    cache_file = '{}.npy'.format(calc_file)
+    if cache and os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(calc_file):
+        x_calc, y_calc = np.load(cache_file)
+    else:
+        with open(calc_file) as f:
+            header = [f.readline() for _ in range(header_rows)]
+            y_calc = np.array(f.read().split(), dtype=float)
+        eph_init = _parse_header(header[1], data_type=float)
+        eph_fin = _parse_header(header[2], data_type=float)
+        n_points = _parse_header(header[3], data_type=int)
+        x_calc = np.linspace(eph_init, eph_fin, n_points)
+        assert n_points == len(y_calc), \
+            'Number of points {} does not match the length of the read data {}'.format(len(y_calc), n_points)
+        if cache:
+            try:
+                np.save(cache_file, np.array([x_calc, y_calc]))
+            except (IOError, OSError):
+                pass  # e.g., a read-only directory, the cache is optional
     fwhm_exp = _calc_fwhm(x_calc, y_calc)
     return x_calc, y_calc, fwhm_exp
 
@@ -127,6 +239,17 @@ def _calc_fwhm(x, y):
     return fwhm
 
 
+def _init_worker():
+    # Worker processes never show the plots, so a non-interactive backend is enough:
+    plt.switch_backend('Agg')
+
+
+def _output_basename(exp_file, calc_file):
+    base_calc_file = os.path.basename(calc_file)
+    base_exp_file = os.path.basename(exp_file)
+    return '{}_{}'.format(os.path.splitext(base_exp_file)[0].split('-')[0], os.path.splitext(base_calc_file)[0])
+
+
 def _parse_header(header_row, data_type):
     """Parse the header of a SRW data file.
 
@@ -151,6 +274,14 @@ if __name__ == '__main__':
                         help='convert to energy from Bragg diffraction angle')
     parser.add_argument('--d-spacing', dest='d_spacing', default=None,
                         help='an arbitrary d-spacing of the crystal of the DCM [A]')
+    parser.add_argument('-m', '--method', dest='method', default='grid', choices=('grid', 'refine'),
+                        help='method to search the shift of the calculated data')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=1, type=int,
+                        help='number of parallel processes to score the calculated data files')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='do not use (and create) the binary *.npy cache of the calculated data files')
+    parser.add_argument('--no-plots', dest='no_plots', action='store_true',
+                        help='do not plot individual calculated data files (the summary plot is still produced)')
     args = parser.parse_args()
 
     if (not args.exp_file) or (not args.calc_file and not args.calc_dir):
@@ -190,35 +321,12 @@ if __name__ == '__main__':
 
     ens = []
     cos = []
-    for calc_file in calc_files:
-        x_calc, y_calc, fwhm_calc = read_calc(calc_file=calc_file)
-
-        # Calculate cosine distance:
-        cosine, y_calc_exp_mesh, shift = calc_dist(x_calc=x_calc, y_calc=y_calc,
-                                                   x_exp=x_exp, y_exp=y_exp)
-        print('FWHM exp: {:.5f} eV    FWHM calc: {:.5f} eV'.format(fwhm_exp, fwhm_calc))
-
-        # Plot:
-        save_fig_file = plot_data(exp_file=exp_file, calc_file=calc_file, x_exp=x_exp, y_exp=y_exp,
-                                  y_calc_exp_mesh=y_calc_exp_mesh, cosine=cosine, shift=shift)
-
-        # Save data:
-        columns = ['energy', 'intensity_calc', 'intensity_exp']
-        data = pd.DataFrame(np.array([x_exp, y_calc_exp_mesh, y_exp]).T, columns=columns)
-        fname = os.path.splitext(save_fig_file)[0]
-        file_name_dat = '{}.dat'.format(fname)
-        file_name_csv = '{}.csv'.format(fname)
-        save_data_pandas(file_name_dat, data, columns, index=True, justify='right')
-        data.to_csv(file_name_csv)
-
-        try:
-            ens_value = float(os.path.basename(calc_file).split('_')[4])
-        except:
-            ens_value = -1.
-        ens.append(ens_value)
-        cos.append(cosine)
-
-        print('File: {}    Cosine distance: {:.6f}'.format(save_fig_file, cosine))
+    for r in sweep(calc_files, exp_file=exp_file, x_exp=x_exp, y_exp=y_exp, method=args.method,
+                   plot=not args.no_plots, cache=not args.no_cache, jobs=args.jobs):
+        print('FWHM exp: {:.5f} eV    FWHM calc: {:.5f} eV'.format(fwhm_exp, r['fwhm_calc']))
+        ens.append(r['ens'])
+        cos.append(r['cosine'])
+        print('File: {}    Cosine distance: {:.6f}'.format(r['fig_file'] or r['dat_file'], r['cosine']))
 
     plt.plot(ens, cos)
     plt.grid()
@@ -11,6 +11,8 @@ from databroker import Broker
 from filestore.fs import FileStoreRO  # "file store read-only"
 from metadatastore.mds import MDSRO  # "metadata store read-only"
 
+from databroker_extractor.common.math import reduce_frames
+
 
 def save_hdf5(data, filename='data.h5', dataset='dataset'):
     h5f = h5py.File(filename, 'w')
@@ -20,7 +22,69 @@ def save_hdf5(data, filename='data.h5', dataset='dataset'):
     return status
 
 
-def plot_scan(db, uid, mean=True, num=0, log=True, save=True, noplot=True):
+def save_hdf5_frames(frames, filename='data.h5', dataset='dataset', compression='gzip', compression_opts=None,
+                     shuffle=True, grow_by=64):
+    """Save a stack of images frame by frame, without loading the whole stack in memory.
+
+    The dataset is resizable and chunked per frame, which suits the mostly-zero photon-counting Eiger images well
+    when compressed.
+
+    :param frames: an iterable of 2D images (e.g., the lazy sequence returned by load_data()).
+    :param filename: name of the HDF5 file.
+    :param dataset: name of the dataset.
+    :param compression: None, 'gzip', 'lzf', or 'lz4'/'bitshuffle' (require the hdf5plugin package).
+    :param compression_opts: options of the compression filter (e.g., the gzip level).
+    :param shuffle: if to apply the HDF5 byte shuffle filter (improves compression of integer images).
+    :param grow_by: number of frames to grow the dataset by when the number of frames is unknown.
+    :return: status message.
+    """
+    filter_kwargs = _compression_kwargs(compression, compression_opts, shuffle)
+    try:
+        num_frames = len(frames)
+    except TypeError:
+        num_frames = None
+
+    with h5py.File(filename, 'w') as h5f:
+        r = None
+        i = -1
+        for i, frame in enumerate(frames):
+            frame = np.asarray(frame)
+            if r is None:
+                r = h5f.create_dataset(dataset, shape=(num_frames or grow_by,) + frame.shape,
+                                       maxshape=(None,) + frame.shape, chunks=(1,) + frame.shape, dtype=frame.dtype,
+                                       **filter_kwargs)
+            if i >= r.shape[0]:
+                r.resize(r.shape[0] + grow_by, axis=0)
+            r[i] = frame
+        if r is None:
+            raise ValueError('No frames to save')
+        r.resize(i + 1, axis=0)
+        status = '{} created: {}'.format(r, os.path.abspath(filename))
+    return status
+
+
+def _compression_kwargs(compression, compression_opts=None, shuffle=True):
+    allowed_values = (None, 'gzip', 'lzf', 'lz4', 'bitshuffle')
+    if compression not in allowed_values:
+        raise ValueError('{}: incorrect value. Allowed values: {}'.format(compression, allowed_values))
+    if compression in ('lz4', 'bitshuffle'):
+        try:
+            import hdf5plugin  # registers the filters in h5py
+        except ImportError:
+            raise ImportError('The "{}" compression requires the hdf5plugin package'.format(compression))
+        if compression == 'lz4':
+            return dict(hdf5plugin.LZ4(), shuffle=shuffle)
+        # Bitshuffle does its own shuffling (with LZ4 compression):
+        return dict(hdf5plugin.Bitshuffle())
+    kwargs = {'shuffle': shuffle}
+    if compression:
+        kwargs['compression'] = compression
+        if compression_opts is not None:
+            kwargs['compression_opts'] = compression_opts
+    return kwargs
+
+
+def plot_scan(db, uid, mean=True, num=0, log=True, save=True, noplot=True, compression='gzip'):
     h = db[uid]
     scan_id = h.start.scan_id
     desc = h.start.Measurement
@@ -32,18 +96,21 @@ def plot_scan(db, uid, mean=True, num=0, log=True, save=True, noplot=True):
     imgs = load_data(uid, md['detector'], reverse=True)
     print(uid, scan_id, imgs)
     if save:
-        status = save_hdf5(imgs, filename='{}_{}_{}.h5'.format(time, uid, scan_id), dataset='dataset')
+        status = save_hdf5_frames(imgs, filename='{}_{}_{}.h5'.format(time, uid, scan_id), dataset='dataset',
+                                  compression=compression)
         print(status)
 
     if noplot:
         return
 
+    img = imgs[num] if not mean else reduce_frames(imgs)['mean']
+
     fig = plt.figure()
     ax = fig.add_subplot(111)
     if log:
-        ax.imshow(np.log10(imgs[num]) if not mean else np.log10(np.mean(imgs, axis=0)))
+        ax.imshow(np.log10(img))
     else:
-        ax.imshow(imgs[num] if not mean else np.mean(imgs, axis=0))
+        ax.imshow(img)
     ax.set_title('UID: {}, scan_id: {}\n{}'.format(uid, scan_id, desc))
     plt.show()
 
@@ -7,12 +7,14 @@ from databroker_extractor.common.databroker import activate_beamline_db
 from databroker_extractor.common.databroker import read_single_scan
 from databroker_extractor.common.fit_data import fit_data, plot_data
 from databroker_extractor.common.io import save_data_pandas
+from databroker_extractor.common.metrics import active_cache, enable as enable_metrics_cache
 from databroker_extractor.common.plot import clear_plt
 
 
 def fwhm_vs_current(scans, reverse=False, current='mean', show=True, convert_to_energy=False, material=None,
                     x_label='dcm_bragg', y_label='VFMcamroi1', beamline='SMI', ring_currents=None, harmonic=None,
-                    mode=None, num_bunches=None, delta_bragg=None, d_spacing=None, fwhm_err_pct=2.5, **kwargs):
+                    mode=None, num_bunches=None, delta_bragg=None, d_spacing=None, fwhm_err_pct=2.5, metrics_cache=False,
+                    **kwargs):
     allowed_current_values = ('mean', 'peak', 'first', 'last')
     if current not in allowed_current_values:
         raise ValueError('{}: not allowed. Allowed values: {}'.format(current, allowed_current_values))
@@ -26,6 +28,9 @@ def fwhm_vs_current(scans, reverse=False, current='mean', show=True, convert_to_
         columns.append('espread_left')
         columns.append('espread_right')
     fname = '{}_fwhm_vs_current_{}_to_{}'.format(beamline.lower(), scans[0], scans[-1])
+    if metrics_cache and active_cache() is None:
+        # FWHM of the already studied scans is not recalculated (the path is default_path() if metrics_cache is True):
+        enable_metrics_cache(path=None if metrics_cache is True else metrics_cache)
     db = activate_beamline_db(beamline)
     for i, s in enumerate(scans):
         print('s={}'.format(s))
@@ -37,7 +42,8 @@ def fwhm_vs_current(scans, reverse=False, current='mean', show=True, convert_to_
             convert_to_energy=convert_to_energy,
             material=material,
             delta_bragg=delta_bragg,
-            d_spacing=d_spacing
+            d_spacing=d_spacing,
+            metrics_only=bool(ring_currents)  # the table is only needed for the ring current
         )
         fwhm = d['fwhm']
         espread = fwhm2espread(fwhm, mode=mode, **kwargs) if mode else None
@@ -68,7 +74,7 @@ def fwhm_vs_current(scans, reverse=False, current='mean', show=True, convert_to_
             current = 'manual'
             ring_current = ring_currents[i]
 
-        data.append([np.array(d['data']['time'])[i], ring_current / float(num_bunches), fwhm])
+        data.append([d['scan'].start.time, ring_current / float(num_bunches), fwhm])
         if espread:
             data[-1].append(espread)
             data[-1].append(abs(espread_err_left))
@@ -10,6 +10,7 @@ from chxanalys.chx_packages import load_mask
 from matplotlib.colors import LogNorm
 
 from databroker_extractor.beamlines.eiger_images import save_hdf5
+from databroker_extractor.common.math import reduce_frames
 from databroker_extractor.common.plot import clear_plt
 
 
@@ -64,7 +65,7 @@ if __name__ == '__main__':
         f = h5py.File(hdf5_file_full, 'r')
         data = f['dataset']
 
-        d = (data[img_num] if img_num is not 'mean' else np.mean(data, axis=0)) * mask * chip_mask
+        d = (data[img_num] if img_num != 'mean' else reduce_frames(data)['mean']) * mask * chip_mask
 
         if rotate:
             rotated_data = scipy.ndimage.interpolation.rotate(d, angle=rotate_angle, reshape=False, order=0)
@@ -1,9 +1,28 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import argparse
+import collections
+import copy
+import functools
+import importlib.util
 import json
 import os
 
+# Environment variable to override the path to the JSON config file:
+CONFIG_ENV_VAR = 'DATABROKER_EXTRACTOR_CONFIG'
+
+# Optional modules required by the data formats (checked before any scan is fetched):
+FORMAT_MODULES = {
+    'feather': 'pyarrow',
+    'parquet': 'pyarrow',
+    'h5': 'tables',
+    'hdf5': 'tables',
+}
+
+BeamlineConfig = collections.namedtuple('BeamlineConfig',
+                                        ['name', 'full_name', 'port', 'default_labels', 'mdsro', 'fsro',
+                                         'last_sync_time'])
+
 
 def get_beamline_labels(config_dict, label):
     allowed_labels = ('x_label', 'y_label')
@@ -17,7 +36,7 @@ def get_beamline_units(config_dict, units):
     return config_dict['default_labels'][units]
 
 
-def parse_command_line():
+def parse_command_line(argv=None):
     # Plot a single graph:
     parser = argparse.ArgumentParser(description='Accessing and visualizing data from NSLS-II beamlines')
 
@@ -27,7 +46,8 @@ def parse_command_line():
 
     # Plot data:
     parser.add_argument('-p', '--plot-ids', dest='plot_ids', default=None, nargs='*',
-                        help='plot data for blank-separated scan ids list')
+                        help='plot data for blank-separated scan ids list (beamline:scan_id pairs, e.g. smi:400 '
+                             'chx:19008, are read from several beamlines concurrently)')
     parser.add_argument('-n', '--norm-plots', dest='norm_plots', default=None, choices=('total', 'individual'),
                         help='normalize plots')
     parser.add_argument('-x', '--x-label', dest='x_label', default=None, help='x label to plot')
@@ -45,35 +65,85 @@ def parse_command_line():
 
     # Save data:
     parser.add_argument('-s', '--save-ids', dest='save_ids', default=None, nargs='*',
-                        help='save data for blank-separated scan ids list')
+                        help='save data for blank-separated scan ids list (beamline:scan_id pairs are accepted)')
     parser.add_argument('-r', '--range', dest='range_ids', default=None,
                         help='save data for a range of scan ids list')
     parser.add_argument('-c', '--columns', dest='columns', default=None, nargs='+',
                         help='columns to save to a file')
     parser.add_argument('-i', '--hide-index-column', dest='hide_index_column', action='store_false',
                         help='hide index column in the saved file(s)')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=1, type=int,
+                        help='number of parallel jobs to fetch and save the scans')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='stream only the saved columns and the x/y labels page by page instead of reading full '
+                             'tables (constant memory for large scans)')
+    parser.add_argument('--page-size', dest='page_size', default=1000, type=int,
+                        help='number of events per page in the streaming mode')
+
+    # Local store:
+    parser.add_argument('--local-store', dest='local_store', action='store_true',
+                        help='mirror the read scans in a local on-disk store and reuse them in the next runs')
+    parser.add_argument('--offline', dest='offline', action='store_true',
+                        help='read the scans from the local store only, without connecting to the beamline databases')
+    parser.add_argument('--store-dir', dest='store_dir', default=None,
+                        help='directory of the local store (default: ~/.databroker_extractor/store/<beamline>)')
+    parser.add_argument('--store-size', dest='store_size', default=None, type=float,
+                        help='maximum size of the local store [GB], the least recently used scans are evicted')
 
     # File name variables:
     parser.add_argument('-t', '--timestamp', dest='timestamp', default=None, choices=('scan', 'current'),
                         help='add scan (or current) timestamp to the name of the saved file')
     parser.add_argument('-d', '--data-extension', dest='data_extension', default='dat',
-                        help='extension of the saved file')
+                        help='extension of the saved file (parquet, feather, h5/hdf5 and npz are saved in the '
+                             'corresponding binary formats, other extensions as text)')
+    parser.add_argument('--consolidate', dest='consolidate', default=None,
+                        help='also save data of all scans to a single HDF5 file (*.h5 or *.hdf5), keyed by uid')
+    parser.add_argument('--metrics-cache', dest='metrics_cache', nargs='?', const=True, default=None,
+                        help='reuse FWHM and peak metrics of complete scans from an on-disk cache (optionally at '
+                             'the provided path, ~/.databroker_extractor/metrics.sqlite by default)')
+    parser.add_argument('--profile', dest='profile', nargs='?', const='profile.json', default=None,
+                        help='print the time, bytes and counts per stage of the pipeline (metadata, events, '
+                             'energy_conversion, fwhm, plot, write) and save all the records to a JSON trace '
+                             '(profile.json by default)')
     parser.add_argument('-g', '--graph-extension', dest='graph_extension', default='png',
                         help='extension of the saved graph')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     save_files = False
     if args.save_ids is not None or args.range_ids is not None:
         save_files = True
 
-    if (args.plot_ids is None and not save_files) or not args.beamline:
+    if (args.plot_ids is None and not save_files) or \
+            not (args.beamline or has_beamline_ids(args.plot_ids) or has_beamline_ids(args.save_ids)):
         parser.print_help()
         parser.exit()
 
+    _check_modules(parser, missing_modules(args))
+
     return args, save_files
 
 
+def missing_modules(args):
+    """Find the optional modules required by the parsed options, which are not installed.
+
+    The modules are only looked up (not imported), so the check does not slow down the startup.
+
+    :param args: parsed command line arguments (see parse_command_line()).
+    :return: a dict {module: the option requiring it}.
+    """
+    required = collections.OrderedDict()
+    extension = (args.data_extension or '').lstrip('.').lower()
+    if extension in FORMAT_MODULES:
+        required[FORMAT_MODULES[extension]] = '-d {}'.format(extension)
+    if args.consolidate:
+        required.setdefault('tables', '--consolidate')
+    # The tables of the local store are saved as HDF5 files (see common.store):
+    if getattr(args, 'local_store', False) or getattr(args, 'offline', False):
+        required.setdefault('tables', '--local-store/--offline')
+    return collections.OrderedDict((m, r) for m, r in required.items() if importlib.util.find_spec(m) is None)
+
+
 def parse_range_ids(range_str):
     range_list = range_str.split(':')
     assert len(range_list) == 2, \
@@ -94,6 +164,86 @@ def parse_scan_ids(scans_list):
     return scan_ids
 
 
+def parse_sync_command_line(argv=None):
+    parser = argparse.ArgumentParser(prog='databroker-extractor sync',
+                                     description='Pull new scans from a beamline database into the local store')
+    parser.add_argument('-b', '--beamline', dest='beamline', required=True, choices=read_config(),
+                        help='select beamline to sync')
+    parser.add_argument('--since', dest='since', default=None, type=float,
+                        help='sync scans started after this UNIX timestamp (default: the last synced scan time, or '
+                             'the last 7 days for the first sync; 0 syncs the whole history)')
+    parser.add_argument('--batch-size', dest='batch_size', default=100, type=int,
+                        help='number of scans to sync in one batch')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=4, type=int,
+                        help='number of parallel threads fetching the event data')
+    parser.add_argument('--interval', dest='interval', default=None, type=float,
+                        help='repeat the sync every INTERVAL seconds (run as a periodic background job)')
+    parser.add_argument('--store-dir', dest='store_dir', default=None,
+                        help='directory of the local store (default: ~/.databroker_extractor/store/<beamline>)')
+    parser.add_argument('--store-size', dest='store_size', default=None, type=float,
+                        help='maximum size of the local store [GB], the least recently used scans are evicted')
+    args = parser.parse_args(argv)
+    _check_modules(parser, _missing_store_modules())
+    return args
+
+
+def parse_search_command_line(argv=None):
+    parser = argparse.ArgumentParser(prog='databroker-extractor search',
+                                     description='Search scans in the local index of run-start documents. Unknown '
+                                                 'arguments are passed to databroker-extractor with --plot/--save.')
+    parser.add_argument('-b', '--beamline', dest='beamline', required=True, choices=read_config(),
+                        help='select beamline to search scans for')
+    parser.add_argument('--plan-name', dest='plan_name', default=None, help='plan name (e.g., scan, rel_scan)')
+    parser.add_argument('--motor', dest='motor', default=None, help='scanned motor (e.g., dcm_b)')
+    parser.add_argument('--field', dest='field', default=None, help='recorded field (e.g., elm_sum_all)')
+    parser.add_argument('--measurement', dest='measurement', default=None,
+                        help='a substring of the "Measurement" description')
+    parser.add_argument('--sample', dest='sample', default=None, help='a substring of the sample description')
+    parser.add_argument('--since', dest='since', default=None,
+                        help='earliest scan start (YYYY-MM-DD[ HH:MM[:SS]] or UNIX timestamp)')
+    parser.add_argument('--until', dest='until', default=None,
+                        help='latest scan start (YYYY-MM-DD[ HH:MM[:SS]] or UNIX timestamp)')
+    parser.add_argument('--limit', dest='limit', default=None, type=int, help='maximum number of found scans')
+    parser.add_argument('-u', '--update', dest='update', action='store_true',
+                        help='index new run-start documents from the beamline database first')
+    parser.add_argument('--store-dir', dest='store_dir', default=None,
+                        help='directory of the local store (default: ~/.databroker_extractor/store/<beamline>)')
+    parser.add_argument('--offline', dest='offline', action='store_true',
+                        help='plot/save the found scans from the local store only, without connecting to the beamline '
+                             'database')
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--plot', dest='plot', action='store_true', help='plot the found scans')
+    action.add_argument('--save', dest='save', action='store_true', help='save data and plots of the found scans')
+    args, extra_args = parser.parse_known_args(argv)
+    _check_modules(parser, _missing_store_modules())
+    return args, extra_args
+
+
+def has_beamline_ids(scans_list):
+    return any(':' in str(x) for x in scans_list or [])
+
+
+def parse_beamline_scan_ids(scan_ids, beamline=None):
+    """Qualify the scan ids with the beamline, keeping the 'beamline:scan_id' pairs as is.
+
+    :param scan_ids: a list of scan ids (int), uids and/or 'beamline:scan_id' strings.
+    :param beamline: beamline of the scan ids without a beamline.
+    :return: a list of 'BEAMLINE:scan_id' strings.
+    """
+    qualified = []
+    for scan_id in scan_ids:
+        scan_id = str(scan_id)
+        if ':' in scan_id:
+            scan_beamline, scan_id = scan_id.split(':', 1)
+        elif beamline:
+            scan_beamline = beamline
+        else:
+            raise ValueError('{}: the beamline of the scan is not specified (use beamline:scan_id or -b)'.format(
+                scan_id))
+        qualified.append('{}:{}'.format(get_beamline_config(scan_beamline).name, scan_id))
+    return qualified
+
+
 def parse_studies():
     parser = argparse.ArgumentParser(description='Select a study to fit by parabola')
     parser.add_argument('-b', '--beamline', dest='beamline', default=None, choices=read_config(),
@@ -111,17 +261,97 @@ def parse_studies():
     return args
 
 
+def get_beamline_config(beamline, **kwargs):
+    """Get a typed config record of the beamline.
+
+    :param beamline: beamline name (case-insensitive).
+    :return: BeamlineConfig record.
+    """
+    configs = _beamline_configs(_config_path(**kwargs))
+    try:
+        return configs[beamline.upper()]
+    except KeyError:
+        raise ValueError('Beamline "{}" is not allowed. Allowed beamlines: {}'.format(beamline, sorted(configs)))
+
+
 def read_config(beamline=None, config_dir='config', config_file='beamlines.json'):
-    config_path = os.path.join(
+    config_dict = _load_config(_config_path(config_dir=config_dir, config_file=config_file))
+    if beamline:
+        return copy.deepcopy(config_dict[beamline.upper()])
+    else:
+        return [x.lower() for x in config_dict.keys()] + [x.upper() for x in config_dict.keys()]
+
+
+def update_config(beamline, config_dir='config', config_file='beamlines.json', **values):
+    """Update the values of the beamline in the JSON config file (e.g., the time of the last synced scan).
+
+    :param beamline: beamline name (case-insensitive).
+    :param values: values to set.
+    :return: None
+    """
+    config_path = _config_path(config_dir=config_dir, config_file=config_file)
+    with open(config_path) as f:
+        config_dict = json.load(f, object_pairs_hook=collections.OrderedDict)
+    config_dict[beamline.upper()].update(values)
+    tmp_path = '{}.tmp'.format(config_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(config_dict, f, indent=4)
+        f.write('\n')
+    os.replace(tmp_path, config_path)
+    reload_config()
+
+
+def reload_config():
+    """Forget the parsed config files, so they are read again on the next access.
+
+    :return: None
+    """
+    _load_config.cache_clear()
+    _beamline_configs.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _beamline_configs(config_path):
+    configs = collections.OrderedDict()
+    for name, cfg in _load_config(config_path).items():
+        configs[name.upper()] = BeamlineConfig(
+            name=name.upper(),
+            full_name=cfg.get('full_name'),
+            port=cfg.get('port'),
+            default_labels=cfg.get('default_labels', {}),
+            mdsro=cfg['MDSRO'],
+            fsro=cfg['FSRO'],
+            last_sync_time=cfg.get('last_sync_time'),
+        )
+    return configs
+
+
+def _check_modules(parser, missing):
+    if missing:
+        parser.error('the following modules are required by the selected options, but not installed: {}'.format(
+            ', '.join('{} ({})'.format(module, reason) for module, reason in missing.items())))
+
+
+def _missing_store_modules():
+    if importlib.util.find_spec('tables') is None:
+        return collections.OrderedDict([('tables', 'local store')])
+    return collections.OrderedDict()
+
+
+def _config_path(config_dir='config', config_file='beamlines.json'):
+    if os.environ.get(CONFIG_ENV_VAR):
+        return os.path.abspath(os.environ[CONFIG_ENV_VAR])
+    return os.path.join(
         os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
         config_dir,
         config_file,
     )
+
+
+@functools.lru_cache(maxsize=None)
+def _load_config(config_path):
+    """Parse the JSON config file (once per process for each path)."""
     if not os.path.isfile(config_path):
         raise ValueError('{}: JSON config file not found'.format(config_path))
     with open(config_path) as f:
-        config_dict = json.load(f)
-    if beamline:
-        return config_dict[beamline.upper()]
-    else:
-        return [x.lower() for x in config_dict.keys()] + [x.upper() for x in config_dict.keys()]
+        return json.load(f, object_pairs_hook=collections.OrderedDict)
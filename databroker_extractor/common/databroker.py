@@ -1,25 +1,260 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import chxtools.xfuncs as xf  # from https://github.com/NSLS-II-CHX/chxtools/blob/master/chxtools/xfuncs.py
+import concurrent.futures
+import itertools
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
 import numpy as np
-from databroker import Broker
-from filestore.fs import FileStoreRO as FSRO  # file store read-only
-from metadatastore.mds import MDSRO  # metadata store read-only
 
-import databroker_extractor.common.math as c_math
-from databroker_extractor.common.command_line import read_config
+import databroker_extractor.common.energy as c_energy
+import databroker_extractor.common.metrics as c_metrics
+import databroker_extractor.common.profiling as c_prof
+from databroker_extractor.common.command_line import get_beamline_config, read_config
+
+
+class LRUCache(object):
+    """A simple thread-safe least-recently-used cache with hit/miss counters.
+
+    :param maxsize: maximum number of items (None for no limit).
+    :param max_bytes: maximum total size of the items, as passed to put() (None for no limit).
+    """
+
+    def __init__(self, maxsize=128, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, nbytes=0):
+        """Add an item, evicting the least recently used ones above maxsize or max_bytes.
 
+        :param nbytes: size of the item (an item larger than max_bytes is not cached at all).
+        """
+        with self._lock:
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                return
+            self.nbytes += nbytes - self._sizes.pop(key, 0)
+            self._sizes[key] = nbytes
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while ((self.maxsize is not None and len(self._data) > self.maxsize) or
+                   (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                old_key, _ = self._data.popitem(last=False)
+                self.nbytes -= self._sizes.pop(old_key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class Document(dict):
+    """A picklable document with attribute access (like the documents returned by metadatastore)."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class DetachedHeader(object):
+    """A picklable stand-in for a header, holding only the run-start document and the field names.
+
+    It is used to pass already read scans to worker processes.
+    """
 
-def activate_beamline_db(beamline=None):
+    def __init__(self, start, fields):
+        self.start = Document(start)
+        self._fields = list(fields)
+
+    def fields(self):
+        return list(self._fields)
+
+
+# The databroker stack is heavy to import, so it is imported on demand in the functions using it
+# (see benchmarks/startup.py).
+
+# Headers are light (start/stop documents), tables may hold many events (and filled detector images), so they are
+# bounded by their size in memory too:
+_header_cache = LRUCache(maxsize=16384)
+_table_cache = LRUCache(maxsize=32, max_bytes=256 * 1024 ** 2)
+
+# The caches are keyed by a token of the broker, unique for the life of the process (unlike id(db), which is reused by
+# new objects once the broker is garbage collected):
+_broker_tokens = weakref.WeakKeyDictionary()
+_strong_broker_tokens = {}
+_token_counter = itertools.count()
+_tokens_lock = threading.Lock()
+
+
+def activate_beamline_db(beamline=None, local_store=False, store_dir=None, store_size=None, offline=False,
+                         pooled=True):
+    """Create a databroker instance for the beamline.
+
+    By default the broker is taken from the process-wide session registry (see SessionRegistry), so all the callers
+    share one set of connections per beamline.
+
+    :param beamline: beamline name.
+    :param local_store: if to mirror the read scans in a local store (see common.store).
+    :param store_dir: directory of the local store (a per-beamline default is used if None).
+    :param store_size: maximum size of the local store [bytes].
+    :param offline: if to read the scans from the local store only, without connecting to the beamline databases.
+    :param pooled: if to reuse the broker of the beamline from the session registry (a new one is created otherwise).
+    :return: databroker instance.
+    """
     allowed_beamlines = read_config()
     if beamline not in allowed_beamlines:
         raise ValueError('Beamline "{}" is not allowed. Allowed beamlines: {}'.format(beamline, allowed_beamlines))
-    cfg = read_config(beamline=beamline)
-    mds = MDSRO(cfg['MDSRO'])
-    fs = FSRO(cfg['FSRO'])
-    db = Broker(mds, fs)
-    return db
+    if local_store or offline:
+        import databroker_extractor.common.store as c_store
+
+        kwargs = {} if store_size is None else {'max_bytes': store_size}
+        store = c_store.LocalStore(store_dir or c_store.default_store_dir(beamline), **kwargs)
+        return c_store.CachingBroker(None if offline else activate_beamline_db(beamline, pooled=pooled), store)
+    if pooled:
+        return _sessions.get(beamline)
+    return _connect(beamline)
+
+
+class SessionRegistry(object):
+    """A thread-safe registry keeping one broker per beamline for the life of the process.
+
+    The Mongo clients of the metadatastore and the filestore hold thread-safe connection pools, so a single broker is
+    shared by all threads instead of opening new connections on every activate_beamline_db() call.
+    """
+
+    def __init__(self):
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, beamline):
+        key = beamline.upper()
+        with self._lock:
+            session = self._sessions.get(key)
+            connect = session is None
+            if connect:
+                # The registry is not locked while connecting, so the other beamlines can connect concurrently; the
+                # callers asking for the same beamline wait for the future:
+                session = {'db': concurrent.futures.Future(), 'created': time.time(), 'connect_time': None, 'uses': 0}
+                self._sessions[key] = session
+            session['uses'] += 1
+        if connect:
+            try:
+                session['db'].set_result(_connect(key))
+            except BaseException as e:
+                with self._lock:
+                    if self._sessions.get(key) is session:
+                        del self._sessions[key]
+                session['db'].set_exception(e)
+                raise
+            session['connect_time'] = time.time() - session['created']
+        return session['db'].result()
+
+    def close(self, beamline=None):
+        """Disconnect and forget the broker of the beamline (of all beamlines if None).
+
+        :param beamline: beamline name.
+        :return: number of the closed sessions.
+        """
+        with self._lock:
+            keys = list(self._sessions) if beamline is None else [k for k in (beamline.upper(),) if k in self._sessions]
+            sessions = [self._sessions.pop(key) for key in keys]
+        for session in sessions:
+            # A broker which is still connecting is disconnected once it is connected:
+            session['db'].add_done_callback(_disconnect_future)
+        return len(keys)
+
+    def stats(self):
+        """Get statistics of the open sessions.
+
+        :return: a dict {beamline: {'uses', 'age', 'connect_time'}}.
+        """
+        now = time.time()
+        with self._lock:
+            return OrderedDict((k, {'uses': v['uses'], 'age': now - v['created'], 'connect_time': v['connect_time']})
+                               for k, v in self._sessions.items())
+
+    def __contains__(self, beamline):
+        with self._lock:
+            return beamline.upper() in self._sessions
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+_sessions = SessionRegistry()
+
+
+def close_sessions(beamline=None):
+    """Close the pooled broker of the beamline (of all beamlines if None), see SessionRegistry.close()."""
+    return _sessions.close(beamline)
+
+
+def session_stats():
+    """Get statistics of the pooled brokers, see SessionRegistry.stats()."""
+    return _sessions.stats()
+
+
+def cache_stats():
+    """Get hit/miss statistics of the header and table caches.
+
+    :return: a dict with 'headers' and 'tables' statistics.
+    """
+    return {
+        'headers': _header_cache.stats(),
+        'tables': _table_cache.stats(),
+    }
+
+
+def clear_cache():
+    """Drop all cached headers and tables (e.g., to see scans which are still running).
+
+    :return: None
+    """
+    _header_cache.clear()
+    _table_cache.clear()
 
 
 def check_columns(data, columns):
@@ -32,6 +267,142 @@ def check_columns(data, columns):
     return True
 
 
+def detach_scan(scan):
+    """Make a scan returned by read_single_scan() picklable by replacing the header with a DetachedHeader.
+
+    :param scan: a dict returned by read_single_scan().
+    :return: a shallow copy of the dict with the detached header.
+    """
+    detached = dict(scan)
+    detached['scan'] = DetachedHeader(start=scan['scan'].start, fields=scan['fields'])
+    return detached
+
+
+def split_beamline_id(scan_id):
+    """Split a 'beamline:scan_id' string (e.g., 'smi:400' or 'chx:1a2b3c') into the beamline and the scan id.
+
+    :param scan_id: scan id (int), uid, or a 'beamline:scan_id' string.
+    :return: beamline name (upper case, None if the scan id has no beamline) and scan id (int) or uid.
+    """
+    if isinstance(scan_id, str) and ':' in scan_id:
+        beamline, scan_id = scan_id.split(':', 1)
+        try:
+            scan_id = int(scan_id)
+        except ValueError:
+            pass
+        return beamline.upper(), scan_id
+    return None, scan_id
+
+
+def resolve_scan(db, scan_id):
+    """Get the databroker instance and the scan id (without the beamline) of a scan.
+
+    :param db: databroker instance, a dict {beamline (upper case): databroker instance}, or None. The pooled broker of
+               the beamline (see activate_beamline_db()) is used for 'beamline:scan_id' scans not found in the dict.
+    :param scan_id: scan id (int), uid, or a 'beamline:scan_id' string.
+    :return: databroker instance and scan id.
+    """
+    beamline, plain_id = split_beamline_id(scan_id)
+    if beamline is None:
+        if db is None or isinstance(db, dict):
+            raise ValueError('{}: the beamline of the scan is not specified (use beamline:scan_id)'.format(scan_id))
+        return db, scan_id
+    if isinstance(db, dict) and beamline in db:
+        return db[beamline], plain_id
+    return activate_beamline_db(beamline), plain_id
+
+
+def beamline_label(label, beamline):
+    """Get the label for the beamline, if the label is given per beamline as a dict {beamline: label}."""
+    return label.get(beamline) if isinstance(label, dict) else label
+
+
+def get_header(db, scan_id):
+    """Get a header for the provided scan id or uid, hitting the metadatastore only once per scan.
+
+    Negative scan ids (e.g., -1 for the last scan) are relative to the current state of the database, so they are
+    always resolved by the broker; the found header is still cached by its uid.
+
+    :param db: databroker instance.
+    :param scan_id: scan id (int) or uid (full or a prefix), optionally as 'beamline:scan_id' (see resolve_scan()).
+    :return: the header of the scan.
+    """
+    db, scan_id = resolve_scan(db, scan_id)
+    cacheable = _is_cacheable(scan_id)
+    token = _broker_token(db)
+    key = (token, scan_id)
+    if cacheable:
+        header = _header_cache.get(key)
+        if header is not None:
+            return header
+    with c_prof.stage('metadata', scan=scan_id) as info:
+        header = db[scan_id]
+        info['scan'] = header.start.uid
+        info['count'] = 1
+    if cacheable:
+        _header_cache.put(key, header)
+    _header_cache.put((token, header.start.uid), header)
+    return header
+
+
+def get_headers(db, scan_ids, batch_size=500):
+    """Resolve many scan ids and uid prefixes at once, with a few '$in'/'$regex' queries instead of one per scan.
+
+    Ambiguous uid prefixes and missing scans are all reported at once, before any data are read. Scan ids resolve to
+    the latest scan with this id (as db[scan_id] does). Negative scan ids are resolved one by one.
+
+    :param db: databroker instance (or a CachingBroker, whose local store is checked first).
+    :param scan_ids: a list of scan ids (int) and/or uids (full or prefixes).
+    :param batch_size: maximum number of ids per query.
+    :return: a list of headers in the order of scan_ids.
+    """
+    groups = _group_by_beamline(scan_ids)
+    if any(beamline is not None for beamline in groups):
+        # 'beamline:scan_id' scans are resolved by the databases of the beamlines concurrently:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [(ids, executor.submit(get_headers, resolve_scan(db, ids[0])[0],
+                                             [split_beamline_id(i)[1] for i in ids], batch_size))
+                       for ids in groups.values()]
+            found = {}
+            for ids, future in futures:
+                found.update(zip(ids, future.result()))
+        return [found[scan_id] for scan_id in scan_ids]
+    if scan_ids:
+        db, _ = resolve_scan(db, scan_ids[0])  # fails if there is no broker for the scans without a beamline
+
+    store = getattr(db, 'store', None)
+    token = _broker_token(db)
+    resolved = {}
+    pending = []
+    for scan_id in OrderedDict.fromkeys(scan_ids):
+        if not _is_cacheable(scan_id):
+            resolved[scan_id] = get_header(db, scan_id)
+            continue
+        header = _header_cache.get((token, scan_id))
+        if header is None and store is not None:
+            with c_prof.stage('metadata', scan=scan_id) as info:
+                header = store.get(scan_id)
+                info['count'] = int(header is not None)
+        if header is None:
+            pending.append(scan_id)
+        else:
+            resolved[scan_id] = header
+
+    if pending:
+        remote = db.db if store is not None else db
+        if remote is None:
+            raise KeyError('{}: not found in the local store {} (offline mode)'.format(pending, store.root))
+        # Only the headers are resolved here, the tables are saved to the local store when they are read (see
+        # scan_data()), so the fetching is not serialized before the data are even needed:
+        resolved.update(_find_headers(remote, pending, batch_size=batch_size))
+
+    for scan_id, header in resolved.items():
+        if _is_cacheable(scan_id):
+            _header_cache.put((token, scan_id), header)
+        _header_cache.put((token, header.start.uid), header)
+    return [resolved[scan_id] for scan_id in scan_ids]
+
+
 def get_scans_list(db, keyword):
     """Get a list of scan filtered by the provided keyword.
 
@@ -41,15 +412,19 @@ def get_scans_list(db, keyword):
     return db(keyword)
 
 
-def read_scans(db, scan_ids, x_label, y_label, **kwargs):
+def combine_scans(scans):
+    """Combine the results of read_single_scan() into the lists used for plotting.
+
+    :param scans: a list of dicts returned by read_single_scan().
+    :return: a dict with per-scan lists of ids, uids, x/y values and FWHM values.
+    """
     real_scan_ids = []
     uids = []
     x_list = []
     y_list = []
     fwhm_values = []
     beamline_id = None
-    for scan_id in scan_ids:
-        d = read_single_scan(db, scan_id=scan_id, x_label=x_label, y_label=y_label, **kwargs)
+    for d in scans:
         if not beamline_id:
             beamline_id = d['beamline_id']
         real_scan_ids.append(d['scan_id'])
@@ -65,56 +440,310 @@ def read_scans(db, scan_ids, x_label, y_label, **kwargs):
         'x_list': x_list,
         'y_list': y_list,
         'fwhm_values': fwhm_values,
+        'scans': list(scans),
     }
 
 
-def read_single_scan(db, scan_id, x_label=None, y_label=None, convert_to_energy=False, material=None, delta_bragg=None,
-                     d_spacing=None):
-    s = scan_info(db, scan_id=scan_id)
+def read_scans(db, scan_ids, x_label, y_label, **kwargs):
+    """Read the scans and combine them (see combine_scans()).
+
+    Scans given as 'beamline:scan_id' are read from the databases of their beamlines concurrently, one thread per
+    beamline (see resolve_scan()). The labels may be given per beamline as dicts {beamline: label}. The x values of the
+    scans of a beamline are converted to energy in one call (see bragg_to_energy_many()).
+    """
+    cache = kwargs.pop('cache', True)
+
+    def read(ids):
+        get_headers(db, ids)  # resolve all the scans at once, they are cached for _read_raw_scan()
+        raw = [_read_raw_scan(db, scan_id, x_label=x_label, y_label=y_label, cache=cache) for scan_id in ids]
+        energies = _convert_to_energy_many([r['x_raw'] for r in raw], **kwargs)
+        return [make_scan(r['header'], x_raw=r['x_raw'], y_raw=r['y_raw'], x_label=r['x_label'], y_label=r['y_label'],
+                          data=r['data'], x=x, **kwargs) for r, x in zip(raw, energies)]
+
+    groups = _group_by_beamline(scan_ids)
+    if len(groups) <= 1:
+        return combine_scans(read(scan_ids))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [(ids, executor.submit(read, ids)) for ids in groups.values()]
+        scans = {}
+        for ids, future in futures:
+            scans.update(zip(ids, future.result()))
+    return combine_scans([scans[scan_id] for scan_id in scan_ids])
+
+
+def iter_scan_pages(db, scan_id, fields=None, page_size=1000, fill=False):
+    """Iterate over the events of a scan in pages, without materializing the whole table.
+
+    Only the requested fields are asked from the broker, and the (externally stored) data are not filled by default.
+
+    :param db: databroker instance.
+    :param scan_id: scan id (int) or uid (full or a prefix).
+    :param fields: a list of fields to extract (set to 'None' to extract all fields).
+    :param page_size: maximum number of events per page.
+    :param fill: if to fill the externally stored data (e.g., detector images).
+    :return: a generator of pandas dataframes with 'time' and the fields as columns, indexed by 'seq_num' (like the
+             table returned by scan_data()).
+    """
+    import pandas as pd
+
+    db, scan_id = resolve_scan(db, scan_id)
+    header = get_header(db, scan_id)
+    columns = None if fields is None else ['time'] + [f for f in fields if f != 'time']
+    rows = []
+    seq_nums = []
+    # Only the time spent in the broker is recorded, not the time the consumer spends between the pages:
+    t = [time.perf_counter()]
+
+    def page():
+        data = pd.DataFrame(rows, index=pd.Index(seq_nums, name='seq_num'), columns=columns)
+        c_prof.record('events', scan=header.start.uid, duration=time.perf_counter() - t[0],
+                      nbytes=data.memory_usage(deep=True).sum() if c_prof.is_enabled() else 0, count=len(data))
+        return data
+
+    for event in db.get_events(header, fields=fields, fill=fill):
+        if columns is None:
+            columns = ['time'] + sorted(event['data'])
+        row = {'time': event['time']}
+        row.update(event['data'])
+        rows.append(row)
+        seq_nums.append(event['seq_num'])
+        if len(rows) >= page_size:
+            yield page()
+            rows = []
+            seq_nums = []
+            t[0] = time.perf_counter()
+    if rows:
+        yield page()
+
 
-    scan = db[scan_id]
-    fields = scan.fields()
-    data = scan_data(db, scan_id)
-    x = None
+def make_scan(header, x_raw=None, y_raw=None, x_label=None, y_label=None, data=None, convert_to_energy=False,
+              material=None, delta_bragg=None, d_spacing=None, x=None):
+    """Prepare x/y values, FWHM and the peak metrics of a scan from the raw x/y columns (see read_single_scan() for the
+    result). The metrics of complete scans are reused from the on-disk cache, if it is enabled (see common.metrics).
+
+    :param header: the header of the scan.
+    :param x_raw: raw values of the x column.
+    :param y_raw: raw values of the y column.
+    :param data: the table of the scan (if it was read).
+    :param x: the x values already shifted and converted (see _convert_to_energy_many()), x_raw is not used then.
+    """
+    s = header.start
     y = None
-    if x_label is not None:
-        if check_columns(data=data, columns=[x_label]):
-            delta_bragg = 0.0 if not delta_bragg else float(delta_bragg)
-            if d_spacing:
-                d_spacing = float(d_spacing)
-            x = np.array(data[x_label]) + delta_bragg
-    if convert_to_energy:
-        x = xf.get_EBragg(material, theta_Bragg=np.abs(x), d_spacing=d_spacing) * 1e3  # keV -> eV
-    if y_label is not None:
-        if check_columns(data=data, columns=[y_label]):
-            y = np.array(data[y_label])
-        else:
-            y = None
-    try:
-        fwhm = c_math.calc_fwhm(x, y)['fwhm']
-    except:
-        fwhm = -1
+    delta_bragg = 0.0 if not delta_bragg else float(delta_bragg)
+    if d_spacing:
+        d_spacing = float(d_spacing)
+    if x is None and x_raw is not None:
+        x = np.array(x_raw) + delta_bragg
+        if convert_to_energy:
+            with c_prof.stage('energy_conversion', scan=s.uid) as info:
+                x = c_energy.bragg_to_energy(x, material=material, d_spacing=d_spacing)  # eV
+                info['count'] = np.size(x)
+    if y_raw is not None:
+        y = np.array(y_raw)
+    with c_prof.stage('fwhm', scan=s.uid) as info:
+        info['count'] = np.size(y)
+        metrics = c_metrics.scan_metrics(header, x, y, x_label=x_label, y_label=y_label,
+                                         convert_to_energy=convert_to_energy, material=material,
+                                         delta_bragg=delta_bragg, d_spacing=d_spacing)
+    return _scan_result(header, data=data, x=x, y=y, x_label=x_label, y_label=y_label, metrics=metrics)
 
+
+def _scan_result(header, data=None, x=None, y=None, x_label=None, y_label=None, metrics=None):
+    s = header.start
     return {
-        'scan': scan,
+        'scan': header,
         'beamline_id': s.beamline_id,
         'scan_id': s.scan_id,
         'uid': s.uid,
-        'fields': fields,
+        'fields': header.fields(),
         'data': data,
         'x': x,
         'y': y,
         'x_label': x_label,
         'y_label': y_label,
-        'fwhm': fwhm,
+        'fwhm': metrics['fwhm'],
+        'metrics': metrics,
     }
 
 
-def scan_data(db, scan_id):
-    scan = db[scan_id]
-    return scan.table()
+def read_single_scan(db, scan_id, x_label=None, y_label=None, convert_to_energy=False, material=None, delta_bragg=None,
+                     d_spacing=None, cache=True, metrics_only=False):
+    """Read a scan and prepare its x/y values and metrics (see make_scan()).
+
+    :param cache: if to keep the table in the table cache (see scan_data()).
+    :param metrics_only: if only the metrics are needed; if they are in the metrics cache, the table of the scan is not
+                         read ('data', 'x' and 'y' of the result are None then).
+    """
+    if metrics_only:
+        beamline, _ = split_beamline_id(scan_id)
+        header = get_header(*resolve_scan(db, scan_id))
+        labels = {'x_label': beamline_label(x_label, beamline), 'y_label': beamline_label(y_label, beamline)}
+        metrics = c_metrics.cached_metrics(header, convert_to_energy=convert_to_energy, material=material,
+                                           delta_bragg=delta_bragg, d_spacing=d_spacing, **labels)
+        if metrics is not None:
+            return _scan_result(header, metrics=metrics, **labels)
+    raw = _read_raw_scan(db, scan_id, x_label=x_label, y_label=y_label, cache=cache)
+    return make_scan(raw['header'], x_raw=raw['x_raw'], y_raw=raw['y_raw'], x_label=raw['x_label'],
+                     y_label=raw['y_label'], data=raw['data'], convert_to_energy=convert_to_energy, material=material,
+                     delta_bragg=delta_bragg, d_spacing=d_spacing)
+
+
+def _read_raw_scan(db, scan_id, x_label=None, y_label=None, cache=True):
+    """Read the header, the table and the raw x/y columns of a scan (the labels are resolved for its beamline)."""
+    beamline, _ = split_beamline_id(scan_id)
+    x_label = beamline_label(x_label, beamline)
+    y_label = beamline_label(y_label, beamline)
+    db, scan_id = resolve_scan(db, scan_id)
+    scan = get_header(db, scan_id)
+    data = scan_data(db, scan_id, cache=cache)
+    x_raw = None
+    y_raw = None
+    if x_label is not None and check_columns(data=data, columns=[x_label]):
+        x_raw = data[x_label]
+    if y_label is not None and check_columns(data=data, columns=[y_label]):
+        y_raw = data[y_label]
+    return {'header': scan, 'data': data, 'x_raw': x_raw, 'y_raw': y_raw, 'x_label': x_label, 'y_label': y_label}
+
+
+def _convert_to_energy_many(x_raws, convert_to_energy=False, material=None, delta_bragg=None, d_spacing=None):
+    """Shift the raw x values of several scans and convert them to energy in one call (see bragg_to_energy_many()).
+
+    :param x_raws: raw x values of the scans (None for the scans without the x column).
+    :return: the list of the x values (None for the scans without the x column), or Nones if not converting.
+    """
+    if not convert_to_energy:
+        return [None] * len(x_raws)
+    delta_bragg = 0.0 if not delta_bragg else float(delta_bragg)
+    if d_spacing:
+        d_spacing = float(d_spacing)
+    present = [i for i, x_raw in enumerate(x_raws) if x_raw is not None]
+    energies = [None] * len(x_raws)
+    if not present:
+        return energies
+    with c_prof.stage('energy_conversion', scan='{} scans'.format(len(present))) as info:
+        converted = c_energy.bragg_to_energy_many([np.array(x_raws[i]) + delta_bragg for i in present],
+                                                  material=material, d_spacing=d_spacing)  # eV
+        info['count'] = sum(np.size(x) for x in converted)
+    for i, x in zip(present, converted):
+        energies[i] = x
+    return energies
+
+
+def scan_data(db, scan_id, cache=True):
+    """Get the table of a scan.
+
+    :param db: databroker instance.
+    :param scan_id: scan id (int) or uid (full or a prefix).
+    :param cache: if to keep the table in the table cache (tables read once, e.g., by exports, should not be kept).
+    :return: pandas dataframe.
+    """
+    db, scan_id = resolve_scan(db, scan_id)
+    scan = get_header(db, scan_id)
+    key = (_broker_token(db), scan.start.uid)
+    data = _table_cache.get(key)
+    if data is None:
+        with c_prof.stage('events', scan=scan.start.uid) as info:
+            data = scan.table()
+            info['bytes'] = nbytes = data.memory_usage(deep=True).sum()
+            info['count'] = len(data)
+        store = getattr(db, 'store', None)
+        if store is not None and not store.has(scan.start.uid):
+            store.put(scan, data=data)
+        if cache:
+            _table_cache.put(key, data, nbytes=nbytes)
+    return data
 
 
 def scan_info(db, scan_id):
-    scan = db[scan_id]
-    return scan.start
+    return get_header(db, scan_id).start
+
+
+def _broker_token(db):
+    with _tokens_lock:
+        try:
+            token = _broker_tokens.get(db)
+            if token is None:
+                token = _broker_tokens[db] = next(_token_counter)
+        except TypeError:
+            # Not weak-referenceable, so the broker is kept alive to keep its id from being reused:
+            token = _strong_broker_tokens.setdefault(id(db), (db, next(_token_counter)))[1]
+    return token
+
+
+def _connect(beamline):
+    from databroker import Broker
+    from filestore.fs import FileStoreRO as FSRO  # file store read-only
+    from metadatastore.mds import MDSRO  # metadata store read-only
+
+    cfg = get_beamline_config(beamline)
+    mds = MDSRO(dict(cfg.mdsro))
+    fs = FSRO(dict(cfg.fsro))
+    db = Broker(mds, fs)
+    return db
+
+
+def _disconnect(db):
+    for store in (getattr(db, 'mds', None), getattr(db, 'fs', None)):
+        disconnect = getattr(store, 'disconnect', None)
+        if disconnect is not None:
+            disconnect()
+
+
+def _disconnect_future(future):
+    if future.exception() is None:
+        _disconnect(future.result())
+
+
+def _find_headers(db, scan_ids, batch_size=500):
+    scan_ids = list(scan_ids)
+    int_ids = [s for s in scan_ids if not isinstance(s, str)]
+    prefixes = [s for s in scan_ids if isinstance(s, str)]
+    found = {}
+
+    # Each batched query is recorded as one 'metadata' stage, counting the headers it returned:
+    for i in range(0, len(int_ids), batch_size):
+        with c_prof.stage('metadata', scan='scan_id $in ({} ids)'.format(len(int_ids[i:i + batch_size]))) as info:
+            headers = list(db(scan_id={'$in': [int(s) for s in int_ids[i:i + batch_size]]}))
+            info['count'] = len(headers)
+        for h in headers:
+            s = h.start.scan_id
+            if s not in found or h.start.time > found[s].start.time:
+                found[s] = h
+
+    matches = OrderedDict((p, OrderedDict()) for p in prefixes)
+    for i in range(0, len(prefixes), batch_size):
+        batch = prefixes[i:i + batch_size]
+        regex = '^({})'.format('|'.join(re.escape(p) for p in batch))
+        with c_prof.stage('metadata', scan='uid $regex ({} prefixes)'.format(len(batch))) as info:
+            headers = list(db(uid={'$regex': regex}))
+            info['count'] = len(headers)
+        for h in headers:
+            for p in batch:
+                if h.start.uid.startswith(p):
+                    matches[p][h.start.uid] = h
+    ambiguous = {p: list(m) for p, m in matches.items() if len(m) > 1}
+    if ambiguous:
+        raise ValueError('Ambiguous uid prefixes: {}'.format(
+            '; '.join('{} -> {}'.format(p, ', '.join(uids)) for p, uids in ambiguous.items())))
+    found.update((p, list(m.values())[0]) for p, m in matches.items() if m)
+
+    missing = [s for s in scan_ids if s not in found]
+    if missing:
+        raise ValueError('Scans not found: {}'.format(missing))
+    return found
+
+
+def _group_by_beamline(scan_ids):
+    groups = OrderedDict()
+    for scan_id in scan_ids:
+        groups.setdefault(split_beamline_id(scan_id)[0], []).append(scan_id)
+    return groups
+
+
+def _is_cacheable(scan_id):
+    if isinstance(scan_id, str):
+        return True
+    try:
+        return int(scan_id) >= 0
+    except (TypeError, ValueError):
+        return False
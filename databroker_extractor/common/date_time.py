@@ -21,12 +21,31 @@ def humanize_time(timestamp, time_format='%Y-%m-%d %H:%M:%S', for_file_name=Fals
     return datetime.datetime.fromtimestamp(timestamp=timestamp).strftime(time_format)
 
 
-def scan_timestamp(scan_id, timestamp):
+def parse_time(value, formats=('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')):
+    """Convert a date/time string (local time) or a UNIX timestamp string to a UNIX timestamp.
+
+    :param value: e.g., '2017-03-18', '2017-03-18 12:30' or '1489854600'.
+    :param formats: allowed date/time formats.
+    :return: UNIX timestamp.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for time_format in formats:
+        try:
+            return time.mktime(datetime.datetime.strptime(value, time_format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError('{}: incorrect date/time. Allowed formats: {}'.format(value, formats))
+
+
+def scan_timestamp(db, scan_id, timestamp, start=None):
     allowed_values = (None, 'scan', 'current')
     if timestamp is None:
         t = ''
     elif timestamp == 'scan':
-        s = c_db.scan_info(scan_id=scan_id)
+        s = start if start is not None else c_db.scan_info(db, scan_id=scan_id)
         t = s.time
     elif timestamp == 'current':
         t = current_timestamp()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import functools
+import re
+
+import numpy as np
+
+# A native replacement of chxtools.xfuncs.get_EBragg(): the crystal constants are computed once per (material,
+# d_spacing, delta_bragg) and memoized, the conversions are vectorized over whole scans or lists of scans.
+
+# Planck constant times the speed of light [keV * A] (CODATA 2018):
+HC = 12.398419843320026
+
+# d-spacings of the reflections tabulated in chxtools.xfuncs.get_EBragg() [A] (T=25C from the mincryst database, the
+# cryo-cooled Si111 and Si220 at 80K from XOP). They take precedence over the lattice constants below:
+D_SPACINGS = {
+    'Si111cryo': 3.13379852,
+    'Si220cryo': 1.91905183,
+    'Si111': 3.13542,
+    'Si220': 1.92004,
+    'Si113': 1.63742,
+    'Si224': 1.10854,
+    'Si331': 1.24589,
+    'Si400': 1.35767,
+    'Ge111': 3.26627,
+    'Ge220': 2.00018,
+    'Ge113': 1.70576,
+    'Ge224': 1.15480,
+    'Ge331': 1.29789,
+    'Ge620': 0.89451,
+    'Ge531': 0.95627,
+    'Ge400': 1.41434,
+    'Ge115': 1.08876,
+    'Ge335': 0.86274,
+    'Ge440': 1.00009,
+    'Ge444': 0.81657,
+    'Ge333': 1.08876,
+    'C111': 2.05929,
+    'C220': 1.26105,
+}
+
+# Lattice constants of the cubic crystals [A], used for the reflections missing in D_SPACINGS. Si at room temperature
+# is the CODATA 2018 value (22.5 C), the cryo-cooled Si is derived from the tabulated Si111cryo d-spacing:
+LATTICE_CONSTANTS = {
+    'Si': 5.431020511,
+    'Sicryo': 5.42789826,
+    'Ge': 5.6579060,
+    'C': 3.56712,
+}
+
+# Energies [eV] calculated by chxtools.xfuncs.get_EBragg() at the Bragg angle of 12 deg (see check_reference()):
+REFERENCE_ENERGIES = {
+    'Si111cryo': 9514.50758805046,
+    'Si220cryo': 15537.125851343631,
+    'Si111': 9509.587167894986,
+    'Ge111': 9128.623720011296,
+    'C111': 14479.04364997708,
+}
+
+Crystal = collections.namedtuple('Crystal', ['material', 'd_spacing', 'delta_bragg', 'energy_factor'])
+
+_material_re = re.compile(r'^(?P<element>[A-Z][a-z]?)(?P<h>\d)(?P<k>\d)(?P<l>\d)(?P<cryo>cryo)?$')
+
+
+def crystal(material='Si111cryo', d_spacing=None, delta_bragg=None):
+    """Get the (memoized) constants of the crystal.
+
+    :param material: reflection of the crystal, e.g. 'Si111cryo', 'Si220', 'Ge111' (ignored if d_spacing is set).
+    :param d_spacing: an arbitrary d-spacing of the crystal [A].
+    :param delta_bragg: offset of the Bragg angle [deg].
+    :return: Crystal record with the d-spacing [A], the offset [deg] and the energy factor hc / 2d [eV].
+    """
+    return _crystal(material or None, float(d_spacing) if d_spacing else None,
+                    float(delta_bragg) if delta_bragg else 0.0)
+
+
+def d_spacing_of(material):
+    """Get d-spacing of the reflection of a cubic crystal.
+
+    The tabulated d-spacings (see D_SPACINGS) are used if available, otherwise d = a / sqrt(h^2 + k^2 + l^2).
+
+    :param material: reflection of the crystal, e.g. 'Si111cryo'.
+    :return: d-spacing [A].
+    """
+    if material in D_SPACINGS:
+        return D_SPACINGS[material]
+    match = _material_re.match(material or '')
+    if not match:
+        raise ValueError('{}: the material must be <element><hkl>[cryo], e.g. Si111cryo, or set the d-spacing'.format(
+            material))
+    lattice_key = match.group('element') + (match.group('cryo') or '')
+    if lattice_key not in LATTICE_CONSTANTS:
+        raise ValueError('{}: unknown crystal. Known crystals: {}'.format(lattice_key, sorted(LATTICE_CONSTANTS)))
+    h, k, l = (int(match.group(x)) for x in 'hkl')
+    return LATTICE_CONSTANTS[lattice_key] / np.sqrt(h ** 2 + k ** 2 + l ** 2)
+
+
+def bragg_to_energy(theta, material='Si111cryo', d_spacing=None, delta_bragg=None):
+    """Convert the Bragg angle to the photon energy, E = hc / (2 d sin|theta + delta_bragg|).
+
+    :param theta: Bragg angle(s) [deg].
+    :param material: reflection of the crystal (see crystal()).
+    :param d_spacing: an arbitrary d-spacing of the crystal [A].
+    :param delta_bragg: offset of the Bragg angle [deg].
+    :return: photon energy [eV] (a numpy array of the shape of theta).
+    """
+    c = crystal(material, d_spacing=d_spacing, delta_bragg=delta_bragg)
+    theta = np.asarray(theta, dtype=float)
+    if c.delta_bragg:
+        theta = theta + c.delta_bragg
+    return c.energy_factor / np.sin(np.radians(np.abs(theta)))
+
+
+def energy_to_bragg(energy, material='Si111cryo', d_spacing=None, delta_bragg=None):
+    """Convert the photon energy to the Bragg angle (the inverse of bragg_to_energy()).
+
+    :param energy: photon energy [eV].
+    :param material: reflection of the crystal (see crystal()).
+    :param d_spacing: an arbitrary d-spacing of the crystal [A].
+    :param delta_bragg: offset of the Bragg angle [deg].
+    :return: Bragg angle(s) [deg].
+    """
+    c = crystal(material, d_spacing=d_spacing, delta_bragg=delta_bragg)
+    energy = np.asarray(energy, dtype=float)
+    if np.any(energy < c.energy_factor):
+        raise ValueError('The energy is below the minimal energy of the crystal ({:.3f} eV)'.format(c.energy_factor))
+    return np.degrees(np.arcsin(c.energy_factor / energy)) - c.delta_bragg
+
+
+def bragg_to_energy_many(theta_list, material='Si111cryo', d_spacing=None, delta_bragg=None):
+    """Convert the Bragg angles of many scans in one vectorized call.
+
+    :param theta_list: a list of arrays of Bragg angles [deg] (of different lengths).
+    :param material: reflection of the crystal (see crystal()).
+    :param d_spacing: an arbitrary d-spacing of the crystal [A].
+    :param delta_bragg: offset of the Bragg angle [deg].
+    :return: a list of arrays of photon energies [eV].
+    """
+    if not len(theta_list):
+        return []
+    arrays = [np.asarray(theta, dtype=float) for theta in theta_list]
+    energies = bragg_to_energy(np.concatenate([a.ravel() for a in arrays]), material=material, d_spacing=d_spacing,
+                               delta_bragg=delta_bragg)
+    splits = np.cumsum([a.size for a in arrays])[:-1]
+    return [e.reshape(a.shape) for e, a in zip(np.split(energies, splits), arrays)]
+
+
+def check_reference(rtol=1e-6):
+    """Check the energies against the values calculated by chxtools (see REFERENCE_ENERGIES).
+
+    :param rtol: allowed relative difference (the value of hc used by chxtools differs by ~1e-7).
+    :return: None
+    """
+    for material, expected in sorted(REFERENCE_ENERGIES.items()):
+        energy = float(bragg_to_energy(12.0, material=material))
+        assert abs(energy / expected - 1) <= rtol, '{}: {:.6f} eV instead of {:.6f} eV'.format(material, energy,
+                                                                                            expected)
+
+
+@functools.lru_cache(maxsize=None)
+def _crystal(material, d_spacing, delta_bragg):
+    if d_spacing is None:
+        d_spacing = d_spacing_of(material)
+    return Crystal(material=material, d_spacing=d_spacing, delta_bragg=delta_bragg,
+                   energy_factor=HC / (2 * d_spacing) * 1e3)
+
+
+if __name__ == '__main__':
+    check_reference()
+    for name in sorted(REFERENCE_ENERGIES):
+        print('{:<10} d={:.8f} A  E(12 deg)={:.3f} eV'.format(name, d_spacing_of(name), bragg_to_energy(12.0, name)))
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import multiprocessing
+import time
+
+import numpy as np
+
+import databroker_extractor.common.databroker as c_db
+import databroker_extractor.common.io as c_io
+import databroker_extractor.common.plot as c_plot
+import databroker_extractor.common.profiling as c_prof
+
+
+def export_scans(db, scan_ids, read_kwargs, plot_kwargs, save_kwargs, jobs=1, consolidate=None, stream=False,
+                 page_size=1000, verbose=True):
+    """Plot and save data for the provided scans.
+
+    With jobs > 1 the scans are fetched from the databroker by a pool of threads, while the plots and the data files
+    are produced by a pool of processes. The number of scans held in memory is bounded by 2 * jobs for each stage. The
+    names and contents of the saved files do not depend on the number of jobs. If the profiling is enabled (see
+    common.profiling), the records of the worker processes are collected by this process.
+
+    With stream=True the full tables are never materialized: only the saved columns and the x/y labels are requested
+    from the broker, page by page, and written incrementally (see iter_scan_pages() and save_data_stream()). The scans
+    are then processed by a pool of jobs threads.
+
+    :param db: databroker instance (or a dict {beamline: databroker instance}, see resolve_scan()).
+    :param scan_ids: a list of scan ids (or uids, or 'beamline:scan_id' strings) to export.
+    :param read_kwargs: keyword arguments for read_single_scan().
+    :param plot_kwargs: keyword arguments for plot_scans().
+    :param save_kwargs: keyword arguments for save_data().
+    :param jobs: number of parallel fetching threads and writing processes.
+    :param consolidate: optional name of an HDF5 file to also save data of all scans to (see save_data_consolidated()).
+    :param stream: if to stream the events instead of reading the full tables.
+    :param page_size: number of events per page in the streaming mode.
+    :param verbose: if to print the progress and the summary.
+    :return: a list of the saved data file names in the order of scan_ids.
+    """
+    jobs = max(1, int(jobs))
+    if stream and consolidate:
+        raise ValueError('Consolidated files are not supported in the streaming mode')
+    t_start = time.time()
+    file_names = [None] * len(scan_ids)
+
+    def consolidate_scan(scan):
+        if consolidate:
+            c_io.save_data_consolidated(consolidate, data=scan['data'], start=scan['scan'].start,
+                                        columns=save_kwargs.get('columns'))
+
+    def report(i, fetch_time, action='fetched'):
+        if verbose:
+            print('    Saved {} ({}/{}, {} in {:.3f} s)'.format(file_names[i], i + 1, len(scan_ids), action, fetch_time))
+
+    if stream:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_stream_scan, db, scan_id, read_kwargs, plot_kwargs, save_kwargs, page_size)
+                       for scan_id in scan_ids]
+            for i, future in enumerate(futures):
+                file_names[i], stream_time = future.result()
+                report(i, stream_time, action='streamed')
+    elif jobs == 1:
+        for i, scan_id in enumerate(scan_ids):
+            scan, fetch_time = _fetch_scan(db, scan_id, read_kwargs)
+            consolidate_scan(scan)
+            file_names[i], _ = _plot_and_save(scan, plot_kwargs, save_kwargs)
+            report(i, fetch_time)
+    else:
+        window = 2 * jobs
+        fetching = collections.deque()
+        writing = {}
+
+        def wait_writes(return_when):
+            done, _ = concurrent.futures.wait(list(writing), return_when=return_when)
+            for future in done:
+                i, fetch_time = writing.pop(future)
+                file_names[i], records = future.result()
+                c_prof.add_records(records)
+                report(i, fetch_time)
+
+        def submit_write():
+            i, future = fetching.popleft()
+            scan, fetch_time = future.result()
+            # The consolidated file is written by this process only, in the order of scan_ids:
+            consolidate_scan(scan)
+            if len(writing) >= window:
+                wait_writes(concurrent.futures.FIRST_COMPLETED)
+            future = writers.submit(_plot_and_save, c_db.detach_scan(scan), plot_kwargs, save_kwargs,
+                                    profile=c_prof.is_enabled())
+            writing[future] = (i, fetch_time)
+
+        # The writers are spawned, not forked: a forked child would inherit the profiling records of this process and
+        # the locks held by the running fetcher threads at the time of the fork.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as fetchers, \
+                concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                                       mp_context=multiprocessing.get_context('spawn')) as writers:
+            for i, scan_id in enumerate(scan_ids):
+                fetching.append((i, fetchers.submit(_fetch_scan, db, scan_id, read_kwargs)))
+                if len(fetching) >= window:
+                    submit_write()
+            while fetching:
+                submit_write()
+            wait_writes(concurrent.futures.ALL_COMPLETED)
+
+    if verbose:
+        elapsed = time.time() - t_start
+        print('Exported {} scans in {:.3f} s ({:.3f} scans/s, jobs={})'.format(
+            len(scan_ids), elapsed, len(scan_ids) / elapsed if elapsed > 0 else float('inf'), jobs))
+    return file_names
+
+
+def _fetch_scan(db, scan_id, read_kwargs):
+    t = time.time()
+    # Exported tables are read once, so they are not kept in the table cache:
+    scan = c_db.read_single_scan(db, scan_id=scan_id, cache=False, **read_kwargs)
+    return scan, time.time() - t
+
+
+def _stream_scan(db, scan_id, read_kwargs, plot_kwargs, save_kwargs, page_size):
+    t = time.time()
+    beamline, _ = c_db.split_beamline_id(scan_id)
+    db, scan_id = c_db.resolve_scan(db, scan_id)
+    read_kwargs = dict(read_kwargs, x_label=c_db.beamline_label(read_kwargs.get('x_label'), beamline),
+                       y_label=c_db.beamline_label(read_kwargs.get('y_label'), beamline))
+    header = c_db.get_header(db, scan_id)
+    x_label = read_kwargs.get('x_label')
+    y_label = read_kwargs.get('y_label')
+    columns = save_kwargs.get('columns')
+    labels = [label for label in (x_label, y_label) if label is not None]
+    fields = None if columns is None else list(columns) + [label for label in labels if label not in columns]
+
+    x_pages = []
+    y_pages = []
+    fetch_time = [0.0]
+
+    def pages():
+        it = iter(c_db.iter_scan_pages(db, header.start.uid, fields=fields, page_size=page_size))
+        while True:
+            t_page = time.perf_counter()
+            page = next(it, None)
+            fetch_time[0] += time.perf_counter() - t_page
+            if page is None:
+                return
+            if c_db.check_columns(data=page, columns=labels):
+                if x_label is not None:
+                    x_pages.append(page[x_label].values)
+                if y_label is not None:
+                    y_pages.append(page[y_label].values)
+            yield page
+
+    file_name = c_io.scan_filename(db, start=header.start, extension=save_kwargs.get('extension', 'dat'),
+                                   timestamp=save_kwargs.get('timestamp'))
+    t_write = time.perf_counter()
+    num_rows = c_io.save_data_stream(file_name, pages(), columns=columns, index=save_kwargs.get('index', False))
+    # The pages are fetched while writing, so the time spent in the broker is not counted as the write time:
+    c_prof.record('write', scan=header.start.uid, duration=time.perf_counter() - t_write - fetch_time[0],
+                  nbytes=c_prof.file_size(file_name) if c_prof.is_enabled() else 0, count=num_rows)
+
+    scan = c_db.make_scan(header, x_raw=np.concatenate(x_pages) if x_pages else None,
+                          y_raw=np.concatenate(y_pages) if y_pages else None, **read_kwargs)
+    c_plot.plot_scans(db, scan_ids=[scan_id], show=False, scans=[scan], **plot_kwargs)
+    return file_name, time.time() - t
+
+
+def _init_worker():
+    # Worker processes never show the plots, so a non-interactive backend is enough:
+    import matplotlib
+    matplotlib.use('Agg')
+    c_prof.reset()
+
+
+def _plot_and_save(scan, plot_kwargs, save_kwargs, profile=False):
+    # The worker processes have their own (disabled) profiling state, so it is enabled on request and the records are
+    # returned to the parent process:
+    if profile:
+        c_prof.enable()
+    c_plot.plot_scans(None, scan_ids=[scan['scan_id']], show=False, scans=[scan], **plot_kwargs)
+    file_name = c_io.save_data(None, scan_id=scan['scan_id'], scan=scan, **save_kwargs)
+    return file_name, c_prof.pop_records() if profile else []
@@ -2,13 +2,13 @@
 # -*- coding: utf-8 -*-
 
 """
-An example of linear and quadratic fit from http://stackoverflow.com/a/28242456/4143531.
+Quadratic fits of the studies (e.g., FWHM vs. elevation or energy spread vs. FWHM), solved in closed form.
 """
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import leastsq
 
 import databroker_extractor.common.command_line as cl
+import databroker_extractor.common.math as c_math
 import databroker_extractor.common.plot as c_plot
 
 
@@ -119,50 +119,39 @@ def input_data(beamline, study='elevation', no_save=True):
     return data, x_label, y_label
 
 
-def fit_data(data):
-    x = data[:, 0]
-    y = data[:, 1]
-
-    # here, create lambda functions for Line, Quadratic fit
-    # tpl is a tuple that contains the parameters of the fit
-    funcLine = lambda tpl, x: tpl[0] * x + tpl[1]
-    funcQuad = lambda tpl, x: tpl[0] * x ** 2 + tpl[1] * x + tpl[2]
-
-    # func is going to be a placeholder for funcLine,funcQuad or whatever
-    # function we would like to fit
-    func = funcLine
-
-    # ErrorFunc is the diference between the func and the y "experimental" data
-    ErrorFunc = lambda tpl, x, y: func(tpl, x) - y
-
-    # tplInitial contains the "first guess" of the parameters
-    tplInitial1 = (1.0, 2.0)
+def fit_harmonics(data, degree=2):
+    """Fit all y columns of a study array (e.g., harmonics) against its first column in one closed-form solve.
 
-    # leastsq finds the set of parameters in the tuple tpl that minimizes
-    # ErrorFunc=yfit-yExperimental
-    tplFinal1, success = leastsq(ErrorFunc, tplInitial1[:], args=(x, y))
-    # print('Linear fit: {}'.format(tplFinal1))
-
-    xx1 = np.linspace(x.min() - np.abs(x.min()) * 0.05, x.max() + np.abs(x.max()) * 0.05, 100)
-    yy1 = func(tplFinal1, xx1)
-
-    # ------------------------------------------------
-    # now the quadratic fit
-    # -------------------------------------------------
-    func = funcQuad
-    tplInitial2 = (1.0, 2.0, 3.0)
-
-    tplFinal2, success = leastsq(ErrorFunc, tplInitial2[:], args=(x, y))
-    print('Quadratic fit: {}'.format(tplFinal2))
-    xx2 = xx1
+    :param data: a 2D array with x values in the first column and y values in the other columns.
+    :param degree: degree of the polynomial (2 - quadratic).
+    :return: a dict with 'x', 'y' (columns, points), 'xx' (a dense mesh of x values), 'yy' (the fitted polynomials on
+             the dense mesh), 'coefs', 'covariance' and 'stderr' (see fit_polynomial()).
+    """
+    x = data[:, 0]
+    y = data[:, 1:]
+    fit = c_math.fit_polynomial(x, y, degree=degree)
+    xx = np.linspace(x.min() - np.abs(x.min()) * 0.05, x.max() + np.abs(x.max()) * 0.05, 100)
+    return {
+        'x': x,
+        'y': y.T,
+        'xx': xx,
+        'yy': c_math.eval_polynomial(fit['coefs'], xx),
+        'coefs': fit['coefs'],
+        'covariance': fit['covariance'],
+        'stderr': fit['stderr'],
+    }
 
-    a = tplFinal2[0]
-    b = tplFinal2[1]
-    min_value = -b / (2 * a)
 
-    yy2 = func(tplFinal2, xx2)
+def fit_data(data):
+    """Fit the second column of a study array against the first one by a parabola (see fit_harmonics()).
 
-    return x, y, xx2, yy2, tplFinal2
+    :param data: a 2D array with x values in the first column and y values in the second column.
+    :return: x, y, a dense mesh of x values, the fitted parabola on it, and the (a, b, c) coefficients of the parabola
+             (as used by fwhm2espread()).
+    """
+    fit = fit_harmonics(data[:, :2], degree=2)
+    print('Quadratic fit: {}'.format(fit['coefs'][0]))
+    return fit['x'], fit['y'][0], fit['xx'], fit['yy'][0], fit['coefs'][0]
 
 
 def plot_data(x, y, xx2, yy2, tplFinal2, x_label, y_label, title=None, no_save=False, file_name='fit_data.png'):
@@ -204,5 +193,8 @@ def plot_data(x, y, xx2, yy2, tplFinal2, x_label, y_label, title=None, no_save=F
 if __name__ == "__main__":
     args = cl.parse_studies()
     data, x_label, y_label = input_data(beamline=args.beamline, study=args.study)
-    x, y, xx2, yy2, tplFinal2 = fit_data(data)
-    plot_data(x, y, xx2, yy2, tplFinal2, x_label, y_label, title=None, no_save=args.no_save)
+    fit = fit_harmonics(data)
+    for i, (coefs, stderr) in enumerate(zip(fit['coefs'], fit['stderr'])):
+        print('Column {}: quadratic fit {} +/- {}'.format(i + 1, coefs, stderr))
+    plot_data(fit['x'], fit['y'][0], fit['xx'], fit['yy'][0], fit['coefs'][0], x_label, y_label, title=None,
+              no_save=args.no_save)
@@ -1,10 +1,23 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import os
+
 import numpy as np
 
 import databroker_extractor.common.databroker as c_db
 import databroker_extractor.common.date_time as c_dt
+import databroker_extractor.common.profiling as c_prof
+
+# Widths of the columns in the text files by the kind of the numpy dtype. Floats are written with full precision (the
+# shortest repr, at most 24 characters), so the widths do not depend on the data and whole tables and pages of a stream
+# are formatted identically:
+_TEXT_WIDTHS = {
+    'f': 24,
+    'i': 20,
+    'u': 20,
+    'b': 5,
+}
 
 
 def format_filename(beamline_id, scan_id, extension='', timestamp=None):
@@ -19,36 +32,155 @@ def format_filename(beamline_id, scan_id, extension='', timestamp=None):
     return format_name.format(*args, extension)
 
 
-def save_data(db, scan_id, columns=None, index=False, extension='dat', **kwargs):
+def save_data(db, scan_id, columns=None, index=False, extension='dat', scan=None, **kwargs):
     """Save data to a file.
 
     :param scan_id: scan id to save data for.
     :param columns: columns to print (set to 'None' to output all columns).
     :param index: if to print the index column.
     :param extension: extension of the file.
+    :param scan: optional already read scan (see read_single_scan()) to avoid fetching the data again.
     :return file_name: name of the saved file.
     """
-    s = c_db.scan_info(db, scan_id=scan_id)
-    file_name = format_filename(
-        beamline_id=s.beamline_id,
-        scan_id=s.scan_id,
-        extension=extension,
-        timestamp=c_dt.scan_timestamp(scan_id=scan_id, **kwargs),
-    )
+    if scan is not None:
+        s = scan['scan'].start
+        data = scan['data']
+    else:
+        s = c_db.scan_info(db, scan_id=scan_id)
+        data = c_db.scan_data(db, scan_id=scan_id)
+    file_name = scan_filename(db, start=s, extension=extension, **kwargs)
 
-    save_data_pandas(
-        file_name=file_name,
-        data=c_db.scan_data(db, scan_id=scan_id),
-        columns=columns,
-        index=index,
-    )
+    with c_prof.stage('write', scan=s.uid) as info:
+        save_data_pandas(
+            file_name=file_name,
+            data=data,
+            columns=columns,
+            index=index,
+        )
+        info['count'] = len(data)
+        info['bytes'] = c_prof.file_size(file_name) if c_prof.is_enabled() else 0
     return file_name
 
 
+def save_data_stream(file_name, pages, columns=None, index=False, justify='left'):
+    """Save pages of a scan table (see iter_scan_pages()) incrementally, keeping only one page in memory.
+
+    The format is selected by the extension of the file: h5/hdf5 (HDF5 table), parquet and csv are appended page by
+    page, any other extension except feather and npz (which cannot be appended to) is written as fixed-width text. The
+    csv and text files are identical to the files written by save_data_pandas() from the whole table.
+
+    :param file_name: name of the file.
+    :param pages: an iterable of pandas dataframes with the same columns.
+    :param columns: columns to save (set to 'None' to save all columns).
+    :param index: if to save the index column.
+    :param justify: justification of the column labels in the text files.
+    :return: number of the saved rows.
+    """
+    extension = _extension(file_name)
+    if extension in ('feather', 'npz'):
+        raise ValueError('{}: the format does not support incremental writing'.format(extension))
+
+    num_rows = 0
+    if extension in ('h5', 'hdf5'):
+        import pandas as pd
+
+        with pd.HDFStore(file_name, mode='w') as store:
+            for page in _select_columns(pages, columns):
+                if not index:
+                    # The rows are numbered continuously across the pages instead of the scan index:
+                    page = page.reset_index(drop=True)
+                    page.index = pd.RangeIndex(num_rows, num_rows + len(page))
+                store.append('data', page, format='table')
+                num_rows += len(page)
+    elif extension == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for page in _select_columns(pages, columns):
+                table = pa.Table.from_pandas(page, preserve_index=index)
+                if writer is None:
+                    writer = pq.ParquetWriter(file_name, table.schema)
+                writer.write_table(table)
+                num_rows += len(page)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        with open(file_name, 'w') as f:
+            for page in _select_columns(pages, columns):
+                _write_text(f, page, index=index, header=not num_rows, justify=justify, csv=extension == 'csv')
+                num_rows += len(page)
+    return num_rows
+
+
+def save_data_consolidated(file_name, data, start, columns=None):
+    """Append data of a scan to a single HDF5 file holding many scans, keyed by uid.
+
+    Each scan is stored as a table under the '/uid_<uid>' key (dashes replaced with underscores), with the scan id,
+    the uid and the beamline id saved as attributes of the table.
+
+    :param file_name: name of the HDF5 file (*.h5 or *.hdf5).
+    :param data: pandas dataframe with the data of the scan.
+    :param start: the run-start document of the scan.
+    :param columns: columns to save (set to 'None' to save all columns).
+    :return: the key of the saved table.
+    """
+    import pandas as pd
+
+    extension = _extension(file_name)
+    if extension not in ('h5', 'hdf5'):
+        raise ValueError('{}: consolidated files must be HDF5 files (*.h5 or *.hdf5)'.format(file_name))
+    c_db.check_columns(data=data, columns=columns)
+    key = 'uid_{}'.format(start.uid.replace('-', '_'))
+    with c_prof.stage('write', scan=start.uid) as info, pd.HDFStore(file_name, mode='a') as store:
+        store.put(key, data if columns is None else data[columns], format='table')
+        attrs = store.get_storer(key).attrs
+        attrs.uid = start.uid
+        attrs.scan_id = start.scan_id
+        attrs.beamline_id = start.beamline_id
+        info['count'] = len(data)
+    return key
+
+
 def save_data_pandas(file_name, data, columns, index, justify='left'):
+    """Save pandas dataframe to a file.
+
+    The format is selected by the extension of the file: parquet, feather (Arrow IPC), h5/hdf5 (HDF5 table) and npz
+    are written by the binary writers, csv as comma-separated values, any other extension as fixed-width text.
+
+    :param file_name: name of the file.
+    :param data: pandas dataframe.
+    :param columns: columns to save (set to 'None' to save all columns).
+    :param index: if to save the index column.
+    :param justify: justification of the column labels in the text files.
+    :return: None
+    """
     if c_db.check_columns(data=data, columns=columns):
-        with open(file_name, 'w') as f:
-            f.write(data.to_string(columns=columns, index=index, justify=justify))
+        writer = _binary_writers.get(_extension(file_name))
+        if writer is not None:
+            writer(file_name, data if columns is None else data[columns], index)
+        else:
+            with open(file_name, 'w') as f:
+                _write_text(f, data if columns is None else data[columns], index=index, header=True, justify=justify,
+                            csv=_extension(file_name) == 'csv')
+
+
+def scan_filename(db, start, extension='dat', timestamp=None):
+    """Get the name of the data file of a scan.
+
+    :param start: the run-start document of the scan.
+    :param extension: extension of the file.
+    :param timestamp: None, 'scan' or 'current' (see scan_timestamp()).
+    :return: name of the file.
+    """
+    return format_filename(
+        beamline_id=start.beamline_id,
+        scan_id=start.scan_id,
+        extension=extension,
+        timestamp=c_dt.scan_timestamp(db, scan_id=start.uid, timestamp=timestamp, start=start),
+    )
 
 
 def save_data_numpy(data, name, header=None):
@@ -60,3 +192,94 @@ def save_data_numpy(data, name, header=None):
         data,
         **kwargs
     )
+
+
+def _select_columns(pages, columns):
+    for page in pages:
+        if c_db.check_columns(data=page, columns=columns):
+            yield page if columns is None else page[columns]
+
+
+def _format_text_value(value):
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    return str(value)
+
+
+def _text_columns(page, index):
+    labels = [str(c) for c in page.columns]
+    values = [page[c].values for c in page.columns]
+    if index:
+        labels.insert(0, str(page.index.name or ''))
+        values.insert(0, page.index.values)
+    return labels, values
+
+
+def _text_widths(labels, values):
+    return [max(len(label), _TEXT_WIDTHS.get(v.dtype.kind, 0)) for label, v in zip(labels, values)]
+
+
+def _write_text(f, data, index, header, justify='left', csv=False):
+    """Write a table (or a page of it) to a csv or a fixed-width text file.
+
+    The output does not depend on how the table is split into pages (see save_data_stream()).
+
+    :param f: file object.
+    :param data: pandas dataframe.
+    :param index: if to write the index column.
+    :param header: if to write the row of the column labels.
+    :param justify: justification of the column labels in the text files.
+    :param csv: if to write comma-separated values.
+    :return: None
+    """
+    if csv:
+        data.to_csv(f, header=header, index=index)
+        return
+    labels, values = _text_columns(data, index)
+    widths = _text_widths(labels, values)
+    lines = []
+    if header:
+        lines.append(' '.join(label.ljust(w) if justify == 'left' else label.rjust(w)
+                              for label, w in zip(labels, widths)))
+    for row in zip(*values):
+        lines.append(' '.join(_format_text_value(v).rjust(w) for v, w in zip(row, widths)))
+    f.write(''.join(line + '\n' for line in lines))
+
+
+def _extension(file_name):
+    return os.path.splitext(file_name)[1].lstrip('.').lower()
+
+
+def _write_feather(file_name, data, index):
+    # Feather does not store non-default indices:
+    data.reset_index(drop=not index).to_feather(file_name)
+
+
+def _write_hdf5(file_name, data, index):
+    # The 'index' argument of to_hdf() controls the PyTables indexing of the columns, the dataframe index is always
+    # written, so it is replaced by the row numbers if it should not be saved:
+    if not index:
+        data = data.reset_index(drop=True)
+    data.to_hdf(file_name, key='data', mode='w', format='table')
+
+
+def _write_npz(file_name, data, index):
+    arrays = {}
+    if index:
+        arrays['index'] = data.index.values
+    for c in data.columns:
+        arrays[str(c)] = data[c].values
+    np.savez(file_name, **arrays)
+
+
+def _write_parquet(file_name, data, index):
+    data.to_parquet(file_name, index=index)
+
+
+_binary_writers = {
+    'feather': _write_feather,
+    'h5': _write_hdf5,
+    'hdf5': _write_hdf5,
+    'npz': _write_npz,
+    'parquet': _write_parquet,
+}
@@ -1,9 +1,14 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import lmfit
+import concurrent.futures
+
 import numpy as np
-from matplotlib import pyplot as plt
+
+# Above this mean number of points per scan, calc_fwhm_many() runs calc_fwhm() per scan: the numpy calls of a single
+# scan are then long enough, and the batched normalization (repeating the minima/maxima over all the points) costs
+# more than the per-scan calls it saves:
+FWHM_BATCH_MAX_POINTS = 2000
 
 
 def calc_fwhm(x, y, shift=0.5, return_as_dict=True):  # MR21062017
@@ -16,49 +21,335 @@ def calc_fwhm(x, y, shift=0.5, return_as_dict=True):  # MR21062017
     :param return_as_dict: if to return a dict with 'fwhm' and 'x_range'
     :return: a value of the FWHM or dictionary consisting of 'fwhm' and 'x_range'
     """
-
-    def is_positive(num):
-        return True if num > 0 else False
+    x = np.asarray(x)
+    y = np.asarray(y)
 
     # Normalize values first:
     y = (y - np.min(y)) / (np.max(y) - np.min(y)) - shift  # roots are at Y=0
 
-    positive = is_positive(y[0])
-    list_of_roots = []
-    for i in range(len(y)):
-        current_positive = is_positive(y[i])
-        if current_positive != positive:
-            list_of_roots.append(x[i - 1] + (x[i] - x[i - 1]) / (abs(y[i]) + abs(y[i - 1])) * abs(y[i - 1]))
-            positive = not positive
-    if len(list_of_roots) >= 2:
+    return _fwhm_from_roots(_find_roots(x, y), return_as_dict=return_as_dict)
+
+
+def calc_fwhm_many(x_list, y_list, shift=0.5, return_as_dict=True, default=None):
+    """Calculate FWHM for many scans (of possibly different lengths) at once, see calc_fwhm() for details.
+
+    Short scans are processed in one vectorized pass, long scans (see FWHM_BATCH_MAX_POINTS) one by one.
+
+    :param x_list: a list of arrays of x values.
+    :param y_list: a list of arrays of y values.
+    :param shift: an optional shift to be used in the process of normalization (between 0 and 1).
+    :param return_as_dict: if to return dicts with 'fwhm' and 'x_range'.
+    :param default: a value returned for the scans with less than 2 roots (an exception is raised if None).
+    :return: a list of FWHM values or dictionaries consisting of 'fwhm' and 'x_range'.
+    """
+    assert len(x_list) == len(y_list), 'The number of x arrays does not match the number of y arrays'
+    if not len(x_list):
+        return []
+    lengths = np.array([len(y) for y in y_list])
+    assert lengths.min() > 0, 'Empty scans are not allowed'
+    if lengths.mean() > FWHM_BATCH_MAX_POINTS:
+        results = []
+        for x_i, y_i in zip(x_list, y_list):
+            try:
+                results.append(calc_fwhm(x_i, y_i, shift=shift, return_as_dict=return_as_dict))
+            except Exception:
+                if default is None:
+                    raise
+                results.append(default)
+        return results
+    x = np.concatenate([np.asarray(v) for v in x_list])
+    y = np.concatenate([np.asarray(v) for v in y_list])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    # Normalize values of each scan first:
+    y_min = np.repeat(np.minimum.reduceat(y, starts), lengths)
+    y_max = np.repeat(np.maximum.reduceat(y, starts), lengths)
+    y = (y - y_min) / (y_max - y_min) - shift  # roots are at Y=0
+
+    # Sign changes across the boundaries of the scans are not roots:
+    boundary = np.zeros(len(y), dtype=bool)
+    boundary[starts] = True
+    idx = _sign_changes(y)
+    idx = idx[~boundary[idx]]
+    roots = _interpolate_roots(x, y, idx)
+
+    results = []
+    for roots_i in np.split(roots, np.searchsorted(idx, starts[1:])):
+        try:
+            results.append(_fwhm_from_roots(roots_i, return_as_dict=return_as_dict))
+        except Exception:
+            if default is None:
+                raise
+            results.append(default)
+    return results
+
+
+def calc_peak_metrics(x, y, shift=0.5):
+    """Calculate FWHM (see calc_fwhm()), the position and the height of the peak, and the centroid of a scan.
+
+    :param x: an array of x values.
+    :param y: an array of y values.
+    :param shift: an optional shift to be used in the process of normalization (between 0 and 1).
+    :return: a dict with 'fwhm' (-1 if it cannot be calculated), 'x_range' (the roots), 'peak_position',
+             'peak_height' and 'centroid' (None if there are no data).
+    """
+    metrics = {'fwhm': -1, 'x_range': [], 'peak_position': None, 'peak_height': None, 'centroid': None}
+    if x is None or y is None or not np.size(y) or np.size(x) != np.size(y):
+        return metrics
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    try:
+        fwhm = calc_fwhm(x, y, shift=shift)
+        metrics['fwhm'] = float(fwhm['fwhm'])
+        metrics['x_range'] = [float(r) for r in fwhm['x_range']]
+    except Exception:
+        pass
+    i = np.argmax(y)
+    metrics['peak_position'] = float(x[i])
+    metrics['peak_height'] = float(y[i])
+    weights = y - np.min(y)
+    total = weights.sum()
+    metrics['centroid'] = float(np.dot(x, weights) / total) if total > 0 else float(x[i])
+    return metrics
+
+
+def _find_roots(x, y):
+    return _interpolate_roots(x, y, _sign_changes(y))
+
+
+def _fwhm_from_roots(roots, return_as_dict=True):
+    if len(roots) >= 2:
+        fwhm = abs(roots[-1] - roots[0])
         if not return_as_dict:
-            return abs(list_of_roots[-1] - list_of_roots[0])
+            return fwhm
         else:
             return {
-                'fwhm': abs(list_of_roots[-1] - list_of_roots[0]),
-                'x_range': list_of_roots,
+                'fwhm': fwhm,
+                'x_range': list(roots),
             }
     else:
         raise Exception('Number of roots is less than 2!')
 
 
+def _interpolate_roots(x, y, idx):
+    return x[idx - 1] + (x[idx] - x[idx - 1]) / (np.abs(y[idx]) + np.abs(y[idx - 1])) * np.abs(y[idx - 1])
+
+
+def _sign_changes(y):
+    """Indices i where the sign of y[i] differs from the sign of y[i - 1] (zero is treated as negative)."""
+    positive = y > 0
+    return np.nonzero(positive[1:] != positive[:-1])[0] + 1
+
+
+def reduce_frames(frames, chunk_size=8, threads=1):
+    """Calculate mean, sum, max and variance images of a stack of frames in bounded memory.
+
+    Only chunk_size frames (per thread) are loaded at once, so the function works for in-memory stacks, HDF5 datasets
+    (e.g., h5py.Dataset) and lazy image sequences much larger than the available memory. The variance is accumulated
+    chunk by chunk with the pairwise algorithm of Chan et al.
+
+    :param frames: a 3D array-like (frames along the first axis) or an iterable of 2D frames.
+    :param chunk_size: number of frames to load at once.
+    :param threads: number of threads reading and reducing the chunks (only for array-likes supporting slicing).
+    :return: a dict with 'count', 'mean', 'sum', 'max' and 'var' (population variance) images.
+    """
+    total = None
+    if hasattr(frames, 'shape') and len(frames.shape) >= 3:
+        starts = list(range(0, frames.shape[0], chunk_size))
+
+        def reduce_chunk(i):
+            return _reduce_chunk(frames[i:i + chunk_size])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            # Submit at most `threads` chunks at once to keep the memory bounded:
+            for j in range(0, len(starts), max(1, threads)):
+                for r in executor.map(reduce_chunk, starts[j:j + max(1, threads)]):
+                    total = _combine_reduced(total, r)
+    else:
+        chunk = []
+        for frame in frames:
+            chunk.append(frame)
+            if len(chunk) == chunk_size:
+                total = _combine_reduced(total, _reduce_chunk(chunk))
+                chunk = []
+        if chunk:
+            total = _combine_reduced(total, _reduce_chunk(chunk))
+
+    if total is None:
+        raise ValueError('No frames to reduce')
+    return {
+        'count': total['count'],
+        'mean': total['mean'],
+        'sum': total['sum'],
+        'max': total['max'],
+        'var': total['m2'] / total['count'],
+    }
+
+
+def _combine_reduced(a, b):
+    if a is None:
+        return b
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    return {
+        'count': count,
+        'mean': a['mean'] + delta * (b['count'] / count),
+        'sum': a['sum'] + b['sum'],
+        'max': np.maximum(a['max'], b['max']),
+        'm2': a['m2'] + b['m2'] + delta ** 2 * (a['count'] * b['count'] / count),
+    }
+
+
+def _reduce_chunk(chunk):
+    chunk = np.asarray(chunk)
+    data = chunk.astype(np.float64)
+    mean = data.mean(axis=0)
+    return {
+        'count': data.shape[0],
+        'mean': mean,
+        'sum': data.sum(axis=0),
+        'max': chunk.max(axis=0),
+        'm2': ((data - mean) ** 2).sum(axis=0),
+    }
+
+
+def fit_polynomial(x, y, degree=2):
+    """Fit the data by a polynomial in closed form (linear least squares on the Vandermonde matrix).
+
+    Many y columns sharing the same x values (e.g., harmonics of a study) are fitted in one solve.
+
+    :param x: an array of x values.
+    :param y: an array of y values, or a 2D array (len(x), number of columns) of y columns.
+    :param degree: degree of the polynomial (1 - linear, 2 - quadratic).
+    :return: a dict with 'coefs' (highest power first, like numpy.polyfit(), e.g. (a, b, c) of a*x**2 + b*x + c),
+             'covariance' (scaled by the reduced chi-square, as in lmfit and scipy.optimize.curve_fit()), 'stderr'
+             (standard errors of the coefficients), 'best_fit' (fitted y values) and 'chisqr' (sum of squared
+             residuals). For 2D y the coefficients, the standard errors and chi-squares have the columns as the first
+             dimension, the covariances are (columns, degree + 1, degree + 1) arrays.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    single = y.ndim == 1
+    if single:
+        y = y[:, np.newaxis]
+    if len(x) != y.shape[0]:
+        raise ValueError('The number of x values ({}) does not match the number of y values ({})'.format(
+            len(x), y.shape[0]))
+    num_params = degree + 1
+    if len(x) < num_params:
+        raise ValueError('At least {} points are required for a polynomial of degree {}'.format(num_params, degree))
+
+    vander = np.vander(x, num_params)
+    coefs, _, _, _ = np.linalg.lstsq(vander, y, rcond=None)  # (num_params, columns)
+    best_fit = np.dot(vander, coefs)
+    chisqr = ((y - best_fit) ** 2).sum(axis=0)
+    dof = len(x) - num_params
+    vander_pinv = np.linalg.pinv(vander)
+    unscaled = np.dot(vander_pinv, vander_pinv.T)
+    scale = chisqr / dof if dof > 0 else np.full_like(chisqr, np.nan)
+    covariance = unscaled[np.newaxis] * scale[:, np.newaxis, np.newaxis]
+    stderr = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2))
+
+    result = {
+        'coefs': coefs.T,
+        'covariance': covariance,
+        'stderr': stderr,
+        'best_fit': best_fit.T,
+        'chisqr': chisqr,
+    }
+    if single:
+        result = {k: v[0] for k, v in result.items()}
+    return result
+
+
+def eval_polynomial(coefs, x):
+    """Evaluate polynomial(s) with the coefficients (highest power first, see fit_polynomial()) at x.
+
+    :param coefs: coefficients of a polynomial, or a 2D array (polynomials, degree + 1).
+    :param x: an array of x values.
+    :return: an array of y values (polynomials, len(x)) for 2D coefs.
+    """
+    coefs = np.asarray(coefs, dtype=float)
+    return np.dot(coefs, np.vander(np.asarray(x, dtype=float), coefs.shape[-1]).T)
+
+
+class FitResult(object):
+    """The result of fit_linear()/fit_quadratic(): the keys of fit_polynomial() with 'values' (the coefficients by name).
+
+    Migration note: the fits returned lmfit.model.ModelResult before, so the attributes used from it are kept
+    (.values, .best_values, .best_fit, .covar, .chisqr, .eval() and .fit_report()). New code should use the keys
+    (result['values'], result['best_fit'], ...). It is not a dict, since .values is a dict here, as in lmfit.
+
+    :param result: the result of fit_polynomial() (for a single y column).
+    :param names: names of the coefficients, highest power first (like the parameters of the lmfit models).
+    """
+
+    def __init__(self, result, names):
+        self.names = tuple(names)
+        self._result = dict(result, values=dict(zip(self.names, result['coefs'])))
+
+    def __getitem__(self, key):
+        return self._result[key]
+
+    def __contains__(self, key):
+        return key in self._result
+
+    def keys(self):
+        return self._result.keys()
+
+    def items(self):
+        return self._result.items()
+
+    @property
+    def values(self):
+        return self['values']
+
+    @property
+    def best_values(self):
+        return self['values']
+
+    @property
+    def best_fit(self):
+        return self['best_fit']
+
+    @property
+    def covar(self):
+        return self['covariance']
+
+    @property
+    def chisqr(self):
+        return self['chisqr']
+
+    def eval(self, x):
+        """Evaluate the fitted polynomial at x (see eval_polynomial())."""
+        return eval_polynomial(self['coefs'], x)
+
+    def fit_report(self):
+        lines = ['[[Fit Statistics]]', '    chi-square = {}'.format(self['chisqr']), '[[Variables]]']
+        for name, value, stderr in zip(self.names, self['coefs'], self['stderr']):
+            lines.append('    {}: {} +/- {}'.format(name, value, stderr))
+        return '\n'.join(lines)
+
+
 def fit_linear(x, y):
-    """See https://lmfit.github.io/lmfit-py/model.html."""
-    m = lmfit.models.LinearModel()
-    params = m.make_params(a=1, b=2)
-    model_result = m.fit(data=y, params=params, x=x)
-    return model_result
+    """Fit the data by a line (see fit_polynomial()).
+
+    :return: FitResult with 'values' {'slope', 'intercept'}.
+    """
+    return FitResult(fit_polynomial(x, y, degree=1), names=('slope', 'intercept'))
 
 
 def fit_quadratic(x, y):
-    """See https://lmfit.github.io/lmfit-py/model.html."""
-    m = lmfit.models.QuadraticModel()
-    params = m.make_params(a=1, b=2, c=3)
-    model_result = m.fit(data=y, params=params, x=x)
-    return model_result
+    """Fit the data by a parabola a*x**2 + b*x + c (see fit_polynomial()).
+
+    :return: FitResult with 'values' {'a', 'b', 'c'}.
+    """
+    return FitResult(fit_polynomial(x, y, degree=2), names=('a', 'b', 'c'))
 
 
 if __name__ == '__main__':
+    from matplotlib import pyplot as plt
+
     # TODO: wrap it to a function and add options to the cl script.
     """
         From http://stackoverflow.com/a/28242456/4143531:
@@ -95,22 +386,22 @@ if __name__ == '__main__':
         y = data[:, i]
 
         # model_result_lin = fit_linear(x=x, y=y)
-        # print(model_result_lin.values)
+        # print(model_result_lin['values'])
 
         model_result_quad = fit_quadratic(x=x, y=y)
-        print(model_result_quad.values)
+        print(model_result_quad['values'])
 
         if print_details:
-            # print(model_result_lin.fit_report())
-            print(model_result_quad.fit_report())
+            print('Standard errors: {}'.format(model_result_quad['stderr']))
+            print('Covariance:\n{}'.format(model_result_quad['covariance']))
 
-        a = model_result_quad.values['a']
-        b = model_result_quad.values['b']
+        a = model_result_quad['values']['a']
+        b = model_result_quad['values']['b']
         min_value = -b / (2 * a)
         print('Min value for {}: {}'.format(harmonics[i], min_value))
 
         plt.plot(x, y, 'bo')
-        plt.plot(x, model_result_quad.best_fit, 'r-')
+        plt.plot(x, model_result_quad['best_fit'], 'r-')
         plt.grid()
         plt.show()
 
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""An on-disk cache of the metrics derived from the scans (FWHM, roots, peak position and height, centroid).
+
+The data of a scan never change after it completes, so the metrics of complete scans (with a stop document) are
+saved in SQLite, keyed by uid, x/y labels and the conversion parameters. The metrics calculated by other versions of
+the algorithm (see ALGORITHM_VERSION) are dropped when the cache is opened.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import databroker_extractor.common.math as c_math
+
+# Bump the version when calc_peak_metrics() (or calc_fwhm(), or the conversion to energy) changes its results. 2: the
+# tabulated d-spacings of the crystals (see common.energy):
+ALGORITHM_VERSION = 2
+
+# Environment variable to override the path to the cache file:
+METRICS_ENV_VAR = 'DATABROKER_EXTRACTOR_METRICS'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metrics (
+    key TEXT PRIMARY KEY,
+    uid TEXT,
+    version INTEGER,
+    metrics TEXT,
+    time REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_uid ON metrics (uid);
+'''
+
+_state = {'cache': None}
+
+
+class MetricsCache(object):
+    """A thread-safe SQLite cache of the metrics of the scans.
+
+    :param path: path to the SQLite file (see default_path()).
+    :param version: version of the algorithm; the metrics of the other versions are dropped.
+    """
+
+    def __init__(self, path=None, version=ALGORITHM_VERSION):
+        self.path = os.path.abspath(path or default_path())
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.execute('DELETE FROM metrics WHERE version != ?', (self.version,))
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT metrics FROM metrics WHERE key = ? AND version = ?',
+                                     (key, self.version)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, uid, metrics):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)',
+                               (key, uid, self.version, json.dumps(metrics), time.time()))
+            self._conn.commit()
+
+    def clear(self, uid=None):
+        """Drop the cached metrics of the scan (of all scans if uid is None).
+
+        :param uid: uid of the scan.
+        :return: None
+        """
+        with self._lock:
+            if uid is None:
+                self._conn.execute('DELETE FROM metrics')
+            else:
+                self._conn.execute('DELETE FROM metrics WHERE uid = ?', (uid,))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute('SELECT COUNT(*) FROM metrics').fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'size': size, 'version': self.version}
+
+
+def enable(path=None):
+    """Use the on-disk cache in scan_metrics() (and thus in read_single_scan()) in this process.
+
+    :param path: path to the SQLite file (see default_path()).
+    :return: MetricsCache instance.
+    """
+    disable()
+    _state['cache'] = MetricsCache(path)
+    return _state['cache']
+
+
+def disable():
+    if _state['cache'] is not None:
+        _state['cache'].close()
+        _state['cache'] = None
+
+
+def active_cache():
+    return _state['cache']
+
+
+def metrics_key(uid, x_label=None, y_label=None, convert_to_energy=False, material=None, delta_bragg=None,
+                d_spacing=None):
+    """Make a key of the metrics of a scan. The material and the d-spacing only matter for the conversion to energy."""
+    return json.dumps([
+        uid,
+        x_label,
+        y_label,
+        bool(convert_to_energy),
+        material if convert_to_energy and not d_spacing else None,
+        float(d_spacing) if convert_to_energy and d_spacing else None,
+        float(delta_bragg) if delta_bragg else 0.0,
+    ])
+
+
+def cached_metrics(header, x_label=None, y_label=None, convert_to_energy=False, material=None, delta_bragg=None,
+                   d_spacing=None):
+    """Get the cached metrics of a complete scan without reading its data (see scan_metrics()).
+
+    :param header: the header of the scan.
+    :return: a dict of the metrics, or None if they are not cached (or the cache is not enabled).
+    """
+    cache = _state['cache']
+    if cache is None or not getattr(header, 'stop', None):
+        return None
+    return cache.get(metrics_key(header.start.uid, x_label=x_label, y_label=y_label,
+                                 convert_to_energy=convert_to_energy, material=material, delta_bragg=delta_bragg,
+                                 d_spacing=d_spacing))
+
+
+def scan_metrics(header, x, y, x_label=None, y_label=None, convert_to_energy=False, material=None, delta_bragg=None,
+                 d_spacing=None):
+    """Get the metrics of a scan (see calc_peak_metrics()), from the cache if it is enabled (see enable()).
+
+    Only complete scans (with a stop document) are cached, the metrics of running scans are always calculated.
+
+    :param header: the header of the scan.
+    :param x: x values (after the conversion).
+    :param y: y values.
+    :return: a dict of the metrics.
+    """
+    cache = _state['cache']
+    if cache is None or not getattr(header, 'stop', None):
+        return c_math.calc_peak_metrics(x, y)
+    uid = header.start.uid
+    key = metrics_key(uid, x_label=x_label, y_label=y_label, convert_to_energy=convert_to_energy, material=material,
+                      delta_bragg=delta_bragg, d_spacing=d_spacing)
+    metrics = cache.get(key)
+    if metrics is None:
+        metrics = c_math.calc_peak_metrics(x, y)
+        cache.put(key, uid, metrics)
+    return metrics
+
+
+def default_path():
+    return os.environ.get(METRICS_ENV_VAR) or os.path.join(os.path.expanduser('~'), '.databroker_extractor',
+                                                           'metrics.sqlite')
@@ -1,50 +1,86 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import threading
+import time
+from collections import OrderedDict
+
 import numpy as np
-from PIL import Image
-from matplotlib import pyplot as plt
 
 import databroker_extractor.common.databroker as c_db
 import databroker_extractor.common.date_time as c_dt
 import databroker_extractor.common.io as c_io
+import databroker_extractor.common.profiling as c_prof
+
+# Per-thread figures reused by the batch (headless) rendering:
+_batch_figures = threading.local()
 
 
 def plot_scans(db, scan_ids, x_label, y_label, x_units=None, y_units=None, norm=None, save=True, show=True,
                scatter_size=10,
                figsize=(8, 6), extension='png', convert_to_energy=False, material='Si111cryo', delta_bragg=None,
-               d_spacing=None, **kwargs):
-    assert len(scan_ids) >= 1, 'The number of scan ids is empty'
-    d = c_db.read_scans(db, scan_ids=scan_ids, x_label=x_label, y_label=y_label,
-                        convert_to_energy=convert_to_energy, material=material, delta_bragg=delta_bragg,
-                        d_spacing=d_spacing)
+               d_spacing=None, scans=None, **kwargs):
+    """Plot the provided scans.
+
+    If the plot is not shown, it is rendered in the batch mode (see batch_figure()), without pyplot.
 
-    s_first = c_db.scan_info(db, scan_id=scan_ids[0])
-    if len(scan_ids) == 1:
-        str_scan_id = s_first.scan_id
+    :param scans: optional list of already read scans (see read_single_scan()) to avoid fetching the data again.
+    """
+    assert len(scan_ids) >= 1, 'The number of scan ids is empty'
+    if scans is None:
+        d = c_db.read_scans(db, scan_ids=scan_ids, x_label=x_label, y_label=y_label,
+                            convert_to_energy=convert_to_energy, material=material, delta_bragg=delta_bragg,
+                            d_spacing=d_spacing)
     else:
-        s_last = c_db.scan_info(db, scan_id=scan_ids[-1])
-        str_scan_id = '{}-{}'.format(s_first.scan_id, s_last.scan_id)
+        assert len(scans) == len(scan_ids), 'The number of scans does not match the number of scan ids'
+        d = c_db.combine_scans(scans)
+
+    s_first = d['scans'][0]['scan'].start
+    beamline_id, str_scan_id = _file_name_ids(d['scans'])
 
     file_name = c_io.format_filename(
-        beamline_id=s_first.beamline_id,
+        beamline_id=beamline_id,
         scan_id=str_scan_id,
         extension=extension,
-        timestamp=c_dt.scan_timestamp(scan_id=s_first.scan_id, **kwargs),
+        timestamp=c_dt.scan_timestamp(db, scan_id=s_first.uid, start=s_first, **kwargs),
     )
 
     y_max = np.hstack(d['y_list']).max()
 
-    clear_plt()
+    t = time.perf_counter()
+    if show:
+        from matplotlib import pyplot as plt
 
-    fig = plt.figure(figsize=figsize)
+        clear_plt()
+        fig = plt.figure(figsize=figsize)
+    else:
+        fig = batch_figure(figsize=figsize)
     ax = fig.add_subplot(111)
 
+    # Labels and units given per beamline (see read_scans()) are shown as the lists of the labels and the units of the
+    # plotted scans:
+    if isinstance(x_label, dict):
+        x_label = ', '.join(OrderedDict.fromkeys(str(scan['x_label']) for scan in d['scans']))
+    if isinstance(y_label, dict):
+        y_label = ', '.join(OrderedDict.fromkeys(str(scan['y_label']) for scan in d['scans']))
+    scan_x_units = [_scan_value(x_units, scan) for scan in d['scans']]
+    if isinstance(x_units, dict):
+        x_units = ', '.join(OrderedDict.fromkeys(str(u) for u in scan_x_units))
+    if isinstance(y_units, dict):
+        y_units = ', '.join(OrderedDict.fromkeys(str(_scan_value(y_units, scan)) for scan in d['scans']))
+
     orig_x_label = x_label
     orig_x_units = x_units
     if convert_to_energy:
         x_label = 'Photon energy'
         x_units = 'eV'
+        scan_x_units = [x_units] * len(d['scans'])
+
+    # Scans of several beamlines may share scan ids, so the ids are prefixed with the beamlines:
+    if len(OrderedDict.fromkeys(scan['beamline_id'] for scan in d['scans'])) > 1:
+        shown_scan_ids = ['{}:{}'.format(str(scan['beamline_id']).lower(), scan['scan_id']) for scan in d['scans']]
+    else:
+        shown_scan_ids = [str(scan_id) for scan_id in d['real_scan_ids']]
 
     scatter_size = float(scatter_size)
 
@@ -62,9 +98,9 @@ def plot_scans(db, scan_ids, x_label, y_label, x_units=None, y_units=None, norm=
         plot_args = (x, y)
         plot_kwargs = {
             'label': 'scan_id={},\nFWHM={:.5f} {}'.format(
-                d['real_scan_ids'][i],
+                shown_scan_ids[i],
                 d['fwhm_values'][i],
-                x_units,
+                scan_x_units[i],
             )
         }
         if scatter_size > 0:
@@ -80,7 +116,7 @@ def plot_scans(db, scan_ids, x_label, y_label, x_units=None, y_units=None, norm=
     ax.set_title(
         'UID:{}\nscan_id: {}'.format(
             d['uids'][-1],
-            ', '.join([str(x) for x in d['real_scan_ids']]),
+            ', '.join(shown_scan_ids),
         )
     )
 
@@ -88,15 +124,44 @@ def plot_scans(db, scan_ids, x_label, y_label, x_units=None, y_units=None, norm=
     ax.set_ylabel(_format_label(y_label, y_units))
     ax.grid()
 
-    plt.tight_layout()
+    fig.tight_layout()
     if save:
-        plt.savefig(file_name)
+        fig.savefig(file_name)
+    c_prof.record('plot', scan=s_first.uid, duration=time.perf_counter() - t,
+                  nbytes=c_prof.file_size(file_name) if save and c_prof.is_enabled() else 0, count=len(scan_ids))
 
     if show:
         plt.show()
 
 
+def batch_figure(figsize=(8, 6)):
+    """Get an empty figure rendered by the Agg canvas directly, bypassing pyplot and its global state.
+
+    The figures are reused across calls (one per figure size and thread), which makes it cheap and safe to save many
+    plots from worker threads or processes.
+
+    :param figsize: size of the figure.
+    :return: matplotlib.figure.Figure object.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    if not hasattr(_batch_figures, 'figures'):
+        _batch_figures.figures = {}
+    key = tuple(figsize)
+    fig = _batch_figures.figures.get(key)
+    if fig is None:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        _batch_figures.figures[key] = fig
+    else:
+        fig.clear()
+    return fig
+
+
 def save_raw_image(data, name):
+    from PIL import Image
+
     im = Image.fromarray(data).convert('L')
     im.save(name)
 
@@ -106,11 +171,42 @@ def clear_plt():
 
     :return: None
     """
+    from matplotlib import pyplot as plt
+
     plt.cla()
     plt.clf()
     plt.close()
 
 
+def _file_name_ids(scans):
+    """Get the beamline and scan id parts of the name of a plot file.
+
+    Scans of one beamline are named by the first and the last scan id (e.g., 'smi' and '1-3'). Scans of several
+    beamlines are named by all the beamlines and the first and the last scan id of each beamline (e.g., 'smi-chx' and
+    'smi1-3_chx2'), so the plot is not mistaken for (and does not overwrite) a plot of a single beamline.
+
+    :param scans: a list of dicts returned by read_single_scan().
+    :return: beamline id and scan id strings.
+    """
+    groups = OrderedDict()
+    for scan in scans:
+        groups.setdefault(scan['scan'].start.beamline_id, []).append(scan['scan'].start.scan_id)
+
+    def id_range(ids):
+        return ids[0] if len(ids) == 1 else '{}-{}'.format(ids[0], ids[-1])
+
+    if len(groups) == 1:
+        beamline_id, ids = list(groups.items())[0]
+        return beamline_id, id_range(ids)
+    return ('-'.join(groups),
+            '_'.join('{}{}'.format(beamline.lower(), id_range(ids)) for beamline, ids in groups.items()))
+
+
+def _scan_value(value, scan):
+    # A value given per beamline as a dict {beamline (upper case): value}:
+    return value.get(str(scan['beamline_id']).upper()) if isinstance(value, dict) else value
+
+
 def _format_label(label, units, orig_label=None, orig_units=None):
     if label == orig_label:
         orig_label = None
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Stages of the extractor pipeline, in the order of the summary table:
+STAGES = ('metadata', 'events', 'energy_conversion', 'fwhm', 'plot', 'write')
+
+_state = {'enabled': False}
+_lock = threading.Lock()
+_records = []
+
+
+def enable():
+    _state['enabled'] = True
+
+
+def disable():
+    _state['enabled'] = False
+
+
+def is_enabled():
+    return _state['enabled']
+
+
+def reset():
+    with _lock:
+        del _records[:]
+
+
+def records():
+    with _lock:
+        return list(_records)
+
+
+def pop_records():
+    """Get and remove all the collected records (e.g., to send them from a worker process to the parent).
+
+    :return: a list of records.
+    """
+    with _lock:
+        r = list(_records)
+        del _records[:]
+    return r
+
+
+def add_records(new_records):
+    with _lock:
+        _records.extend(new_records)
+
+
+def record(name, scan=None, duration=0.0, nbytes=0, count=0, start=None):
+    """Add a record of a stage measured by the caller.
+
+    :param name: name of the stage (see STAGES).
+    :param scan: scan id or uid the stage was run for.
+    :param duration: wall time [s].
+    :param nbytes: number of bytes read or written.
+    :param count: number of items (events, rows, points) processed.
+    :param start: UNIX timestamp of the start of the stage.
+    :return: None
+    """
+    if not _state['enabled']:
+        return
+    add_records([{
+        'stage': name,
+        'scan': scan,
+        'start': time.time() - duration if start is None else start,
+        'duration': duration,
+        'bytes': int(nbytes),
+        'count': int(count),
+        'pid': os.getpid(),
+        'thread': threading.current_thread().name,
+    }])
+
+
+@contextlib.contextmanager
+def stage(name, scan=None):
+    """Measure the wall time of a stage. The yielded dict can be updated with 'bytes', 'count' and 'scan'.
+
+    Nothing is recorded (and the overhead is negligible) unless the profiling is enabled.
+    """
+    info = {'scan': scan, 'bytes': 0, 'count': 0}
+    if not _state['enabled']:
+        yield info
+        return
+    start = time.time()
+    t = time.perf_counter()
+    try:
+        yield info
+    finally:
+        record(name, scan=info['scan'], duration=time.perf_counter() - t, nbytes=info['bytes'], count=info['count'],
+               start=start)
+
+
+def file_size(file_name):
+    return os.path.getsize(file_name) if file_name and os.path.isfile(file_name) else 0
+
+
+def summary():
+    """Aggregate the records per stage and per scan.
+
+    :return: a dict with 'stages' and 'scans' dicts of {'calls', 'time', 'max_time', 'bytes', 'count'}.
+    """
+    stages = collections.OrderedDict((s, _empty_total()) for s in STAGES)
+    scans = collections.OrderedDict()
+    for r in records():
+        for totals, key in ((stages, r['stage']), (scans, r['scan'])):
+            if key not in totals:
+                totals[key] = _empty_total()
+            t = totals[key]
+            t['calls'] += 1
+            t['time'] += r['duration']
+            t['max_time'] = max(t['max_time'], r['duration'])
+            t['bytes'] += r['bytes']
+            t['count'] += r['count']
+    return {
+        'stages': collections.OrderedDict((k, v) for k, v in stages.items() if v['calls']),
+        'scans': scans,
+    }
+
+
+def print_summary(top=10):
+    s = summary()
+    row = '{:<20} {:>8} {:>12} {:>12} {:>12} {:>12} {:>10}'
+    print(row.format('stage', 'calls', 'total [s]', 'mean [ms]', 'max [ms]', 'MB', 'count'))
+    for name, t in s['stages'].items():
+        print(row.format(name, t['calls'], '{:.3f}'.format(t['time']), '{:.1f}'.format(t['time'] / t['calls'] * 1e3),
+                         '{:.1f}'.format(t['max_time'] * 1e3), '{:.2f}'.format(t['bytes'] / 1024. ** 2), t['count']))
+    if s['scans']:
+        print('Slowest scans:')
+        for scan, t in sorted(s['scans'].items(), key=lambda x: x[1]['time'], reverse=True)[:top]:
+            print('    {:<40} {:.3f} s'.format(str(scan), t['time']))
+
+
+def save_trace(file_name):
+    """Save all the records and the summary as JSON.
+
+    :param file_name: name of the JSON file.
+    :return: file_name
+    """
+    with open(file_name, 'w') as f:
+        json.dump({'records': records(), 'summary': _json_keys(summary())}, f, indent=4, default=str)
+    return file_name
+
+
+def _empty_total():
+    return {'calls': 0, 'time': 0.0, 'max_time': 0.0, 'bytes': 0, 'count': 0}
+
+
+def _json_keys(d):
+    return {k: {str(kk): vv for kk, vv in v.items()} for k, v in d.items()}
@@ -0,0 +1,424 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""A local on-disk mirror of the scans read from the beamline databases.
+
+Run-start/stop and descriptor documents are indexed in SQLite (by uid, scan_id and time), the event tables are saved
+as HDF5 files next to the index. The store is filled on first access and can be used without network (offline).
+
+The same SQLite file holds a search index of run-start documents (plan name, motors, detectors, fields, measurement,
+sample and time), which can also be filled with run-start documents only, without the event data.
+"""
+
+import concurrent.futures
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import databroker_extractor.common.databroker as c_db
+
+# Environment variable to override the root directory of the local stores:
+STORE_ENV_VAR = 'DATABROKER_EXTRACTOR_STORE'
+
+# The first sync (without the time of the last synced scan) pulls the scans of this window [s] only:
+DEFAULT_SYNC_WINDOW = 7 * 24 * 3600
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    uid TEXT PRIMARY KEY,
+    scan_id INTEGER,
+    beamline_id TEXT,
+    time REAL,
+    start TEXT,
+    stop TEXT,
+    descriptors TEXT,
+    fields TEXT,
+    table_file TEXT,
+    nbytes INTEGER,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS runs_scan_id ON runs (scan_id);
+CREATE INDEX IF NOT EXISTS runs_time ON runs (time);
+CREATE TABLE IF NOT EXISTS starts (
+    uid TEXT PRIMARY KEY,
+    scan_id INTEGER,
+    time REAL,
+    plan_name TEXT,
+    motors TEXT,
+    detectors TEXT,
+    fields TEXT,
+    measurement TEXT,
+    sample TEXT
+);
+CREATE INDEX IF NOT EXISTS starts_scan_id ON starts (scan_id);
+CREATE INDEX IF NOT EXISTS starts_time ON starts (time);
+CREATE INDEX IF NOT EXISTS starts_plan_name ON starts (plan_name);
+'''
+
+
+class StoredHeader(c_db.DetachedHeader):
+    """A header of a scan from the local store (mimics the databroker header used in common.databroker)."""
+
+    def __init__(self, store, start, stop, descriptors, fields):
+        super(StoredHeader, self).__init__(start=start, fields=fields)
+        self.stop = c_db.Document(stop or {})
+        self.descriptors = [c_db.Document(d) for d in descriptors]
+        self._store = store
+
+    def table(self):
+        return self._store.read_table(self.start.uid)
+
+
+class LocalStore(object):
+    """SQLite index of the run documents plus HDF5 files with the event tables.
+
+    :param root: directory of the store.
+    :param max_bytes: maximum size of the saved tables; the least recently accessed scans are evicted above it.
+    """
+
+    def __init__(self, root, max_bytes=10 * 1024 ** 3):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self._tables_dir = os.path.join(self.root, 'tables')
+        if not os.path.isdir(self._tables_dir):
+            os.makedirs(self._tables_dir)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, scan_id):
+        """Get a stored header by scan id (the latest scan with this id), negative scan id or uid (full or a prefix).
+
+        :return: StoredHeader or None if the scan is not in the store.
+        """
+        if isinstance(scan_id, str):
+            rows = self._query('SELECT * FROM runs WHERE uid LIKE ? LIMIT 2', (scan_id + '%',))
+            if len(rows) > 1:
+                raise ValueError('{}: ambiguous uid prefix'.format(scan_id))
+        elif int(scan_id) < 0:
+            rows = self._query('SELECT * FROM runs ORDER BY time DESC LIMIT 1 OFFSET ?', (-int(scan_id) - 1,))
+        else:
+            rows = self._query('SELECT * FROM runs WHERE scan_id = ? ORDER BY time DESC LIMIT 1', (int(scan_id),))
+        if not rows:
+            return None
+        row = rows[0]
+        with self._lock:
+            self._conn.execute('UPDATE runs SET last_access = ? WHERE uid = ?', (time.time(), row['uid']))
+            self._conn.commit()
+        return self._header(row)
+
+    def put(self, header, data=None):
+        """Save a scan to the store. Scans without a stop document (still running) are not saved.
+
+        :param header: databroker header.
+        :param data: the table of the scan (read from the header if None).
+        :return: StoredHeader or the original header if the scan was not saved.
+        """
+        if not getattr(header, 'stop', None):
+            return header
+        if data is None:
+            data = header.table()
+        start = header.start
+        table_file = '{}.h5'.format(start.uid)
+        table_path = os.path.join(self._tables_dir, table_file)
+        data.to_hdf(table_path, key='data', mode='w')
+        descriptors = getattr(header, 'descriptors', None) or []
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (start.uid, start.get('scan_id'), start.get('beamline_id'), start.get('time'), _dumps(start),
+                 _dumps(header.stop), _dumps(list(descriptors)), _dumps(sorted(header.fields())), table_file,
+                 os.path.getsize(table_path), time.time()),
+            )
+            self._index_start(start, fields=header.fields())
+            self._conn.commit()
+            self.evict()
+        # The scan may have been evicted right away if it is larger than the store:
+        return self.get(start.uid) or header
+
+    def read_table(self, uid):
+        import pandas as pd
+
+        rows = self._query('SELECT table_file FROM runs WHERE uid = ?', (uid,))
+        if not rows:
+            raise KeyError('{}: not found in the local store'.format(uid))
+        return pd.read_hdf(os.path.join(self._tables_dir, rows[0]['table_file']), key='data')
+
+    def iter_events(self, uid, fields=None):
+        """Iterate over the stored events of a scan (like databroker's get_events()).
+
+        :return: a generator of dicts with 'seq_num', 'time' and 'data'.
+        """
+        data = self.read_table(uid)
+        columns = [c for c in data.columns if c != 'time' and (fields is None or c in fields)]
+        for seq_num, row in data.iterrows():
+            yield {
+                'seq_num': seq_num,
+                'time': row['time'] if 'time' in data.columns else None,
+                'data': {c: row[c] for c in columns},
+            }
+
+    def evict(self, max_bytes=None):
+        """Delete the least recently accessed scans until the size of the stored tables is below max_bytes.
+
+        :return: a list of uids of the evicted scans.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        evicted = []
+        with self._lock:
+            total = self.stats()['nbytes']
+            if max_bytes is None or total <= max_bytes:
+                return evicted
+            for row in self._query('SELECT uid, table_file, nbytes FROM runs ORDER BY last_access ASC'):
+                if total <= max_bytes:
+                    break
+                table_path = os.path.join(self._tables_dir, row['table_file'])
+                if os.path.isfile(table_path):
+                    os.remove(table_path)
+                self._conn.execute('DELETE FROM runs WHERE uid = ?', (row['uid'],))
+                total -= row['nbytes']
+                evicted.append(row['uid'])
+            self._conn.commit()
+        return evicted
+
+    def index_starts(self, starts):
+        """Add run-start documents to the search index (without the event data).
+
+        :param starts: an iterable of run-start documents.
+        :return: number of the indexed documents.
+        """
+        num_indexed = 0
+        with self._lock:
+            for start in starts:
+                self._index_start(start)
+                num_indexed += 1
+            self._conn.commit()
+        return num_indexed
+
+    def last_indexed_time(self):
+        return self._query('SELECT MAX(time) AS time FROM starts')[0]['time']
+
+    def search(self, plan_name=None, motor=None, field=None, measurement=None, sample=None, since=None, until=None,
+               limit=None):
+        """Search the indexed run-start documents.
+
+        A field matches the fields of the stored scans, and for the index-only scans, the detectors whose names prefix
+        the field (e.g., the 'elm' detector for the 'elm_sum_all' field), the motors and the field names are checked.
+
+        :param plan_name: plan name (exact).
+        :param motor: motor name (exact).
+        :param field: field name (see above).
+        :param measurement: a substring of the 'Measurement' description.
+        :param sample: a substring of the sample description.
+        :param since: UNIX timestamp of the earliest scan start.
+        :param until: UNIX timestamp of the latest scan start.
+        :param limit: maximum number of results.
+        :return: a list of dicts (uid, scan_id, time, plan_name, motors, detectors, measurement, sample) sorted by time.
+        """
+        conditions = []
+        params = []
+        if plan_name is not None:
+            conditions.append('plan_name = ?')
+            params.append(plan_name)
+        if motor is not None:
+            conditions.append('motors LIKE ?')
+            params.append('%{}%'.format(json.dumps(motor)))
+        for column, value in (('measurement', measurement), ('sample', sample)):
+            if value is not None:
+                conditions.append('{} LIKE ?'.format(column))
+                params.append('%{}%'.format(value))
+        if since is not None:
+            conditions.append('time >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('time <= ?')
+            params.append(until)
+        sql = 'SELECT * FROM starts'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY time ASC'
+
+        results = []
+        for row in self._query(sql, params):
+            for key in ('motors', 'detectors', 'fields'):
+                row[key] = json.loads(row[key]) if row[key] is not None else None
+            if field is not None and not _has_field(row, field):
+                continue
+            results.append(row)
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+    def has(self, uid):
+        return bool(self._query('SELECT 1 FROM runs WHERE uid = ?', (uid,)))
+
+    def stats(self):
+        rows = self._query('SELECT COUNT(*) AS num_scans, COALESCE(SUM(nbytes), 0) AS nbytes FROM runs')
+        return {
+            'root': self.root,
+            'num_scans': rows[0]['num_scans'],
+            'nbytes': rows[0]['nbytes'],
+            'max_bytes': self.max_bytes,
+        }
+
+    def _index_start(self, start, fields=None):
+        sample = start.get('sample')
+        # Re-indexing a run-start document (e.g., from index_remote()) keeps the fields of the stored scan:
+        self._conn.execute(
+            'INSERT INTO starts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(uid) DO UPDATE SET scan_id = excluded.scan_id, time = excluded.time, '
+            'plan_name = excluded.plan_name, motors = excluded.motors, detectors = excluded.detectors, '
+            'fields = COALESCE(excluded.fields, fields), measurement = excluded.measurement, sample = excluded.sample',
+            (start['uid'], start.get('scan_id'), start.get('time'), start.get('plan_name'),
+             _dumps(list(start.get('motors') or [])), _dumps(list(start.get('detectors') or [])),
+             _dumps(sorted(fields)) if fields is not None else None, start.get('Measurement'),
+             None if sample is None else (sample if isinstance(sample, str) else _dumps(sample))),
+        )
+
+    def _header(self, row):
+        return StoredHeader(self, start=json.loads(row['start']), stop=json.loads(row['stop']),
+                            descriptors=json.loads(row['descriptors']), fields=json.loads(row['fields']))
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, r)) for r in cursor.fetchall()]
+
+
+class CachingBroker(object):
+    """A databroker wrapper reading the scans from the local store first.
+
+    The headers of the scans missing in the store come from the remote database, and the scans are saved to the store
+    when their tables are first read (see scan_data()), so resolving the headers never downloads the event data.
+
+    :param db: databroker instance (None for the offline mode).
+    :param store: LocalStore instance.
+    """
+
+    def __init__(self, db, store):
+        self.db = db
+        self.store = store
+
+    @property
+    def offline(self):
+        return self.db is None
+
+    def __getitem__(self, scan_id):
+        # Negative scan ids are relative to the current state of the remote database:
+        if self.offline or isinstance(scan_id, str) or int(scan_id) >= 0:
+            header = self.store.get(scan_id)
+            if header is not None:
+                return header
+        if self.offline:
+            raise KeyError('{}: not found in the local store {} (offline mode)'.format(scan_id, self.store.root))
+        return self.db[scan_id]
+
+    def __call__(self, *args, **kwargs):
+        if self.offline:
+            raise RuntimeError('Searching the remote database is not possible in the offline mode')
+        return self.db(*args, **kwargs)
+
+    def get_events(self, header, fields=None, fill=False, **kwargs):
+        if isinstance(header, StoredHeader):
+            return self.store.iter_events(header.start.uid, fields=fields)
+        if self.offline:
+            raise RuntimeError('Reading events from the remote database is not possible in the offline mode')
+        return self.db.get_events(header, fields=fields, fill=fill, **kwargs)
+
+
+def sync_store(cdb, since=None, batch_size=100, jobs=4, verbose=True):
+    """Pull the scans started after `since` from the remote database into the local store, in batches.
+
+    The headers are read from the query lazily, batch_size at a time, and the event data of a batch are fetched by a
+    pool of threads. Scans which are still running (without a stop document) are not saved, and the returned time never
+    goes past them, so they are picked up by the next sync. Scans evicted right away (when the store is full) do not
+    hold the time back, so they are not downloaded again by every next sync.
+
+    :param cdb: CachingBroker instance (with the remote database).
+    :param since: UNIX timestamp; the scans of the last DEFAULT_SYNC_WINDOW seconds are synced if None (use 0 to sync
+                  the whole history).
+    :param batch_size: number of scans to sync in one batch.
+    :param jobs: number of parallel threads fetching the event data.
+    :param verbose: if to print the progress.
+    :return: number of the synced scans and the time of the last synced scan (to be used as `since` next time).
+    """
+    if cdb.offline:
+        raise RuntimeError('Syncing is not possible in the offline mode')
+    if since is None:
+        since = time.time() - DEFAULT_SYNC_WINDOW
+    headers = (h for h in cdb.db(start_time=since) if h.start.time > since)
+
+    num_seen = 0
+    num_synced = 0
+    complete_times = []
+    running_times = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while True:
+            batch = list(itertools.islice(headers, batch_size))
+            if not batch:
+                break
+            num_seen += len(batch)
+            running = [h for h in batch if not getattr(h, 'stop', None)]
+            running_times.extend(h.start.time for h in running)
+            complete = [h for h in batch if getattr(h, 'stop', None)]
+            complete_times.extend(h.start.time for h in complete)
+            num_synced += len(list(executor.map(cdb.store.put,
+                                                [h for h in complete if not cdb.store.has(h.start.uid)])))
+            if verbose:
+                print('    Checked {} scans, synced {} ({} still running)'.format(num_seen, num_synced,
+                                                                                len(running_times)))
+
+    # The scans are not necessarily returned in the order of time, so the time only advances up to the first running
+    # scan:
+    first_running = min(running_times) if running_times else float('inf')
+    last_time = max([t for t in complete_times if t < first_running] + [since])
+    return num_synced, last_time
+
+
+def index_remote(cdb, since=None, verbose=True):
+    """Add run-start documents of the scans started after `since` to the search index (without the event data).
+
+    :param cdb: CachingBroker instance (with the remote database).
+    :param since: UNIX timestamp (the time of the last indexed scan if None).
+    :return: number of the indexed scans.
+    """
+    if cdb.offline:
+        raise RuntimeError('Indexing the remote database is not possible in the offline mode')
+    if since is None:
+        since = cdb.store.last_indexed_time()
+    query = {} if since is None else {'start_time': since}
+    num_indexed = cdb.store.index_starts(h.start for h in cdb.db(**query))
+    if verbose:
+        print('Indexed {} scans'.format(num_indexed))
+    return num_indexed
+
+
+def default_store_dir(beamline):
+    root = os.environ.get(STORE_ENV_VAR) or os.path.join(os.path.expanduser('~'), '.databroker_extractor', 'store')
+    return os.path.join(root, beamline.lower())
+
+
+def _has_field(row, field):
+    if row['fields'] is not None:
+        return field in row['fields']
+    return (field in (row['motors'] or []) or
+            any(field == d or field.startswith('{}_'.format(d)) for d in (row['detectors'] or [])))
+
+
+def _dumps(doc):
+    return json.dumps(doc, default=_json_default)
+
+
+def _json_default(obj):
+    # numpy scalars and arrays, tuples in documents, etc.:
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
@@ -1,23 +1,66 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import time
+from collections import OrderedDict
+
 import databroker_extractor.common.command_line as cl
-import databroker_extractor.common.io as c_io
+import databroker_extractor.common.databroker as c_db
+import databroker_extractor.common.export as c_export
+import databroker_extractor.common.metrics as c_metrics
 import databroker_extractor.common.plot as c_plot
+import databroker_extractor.common.profiling as c_prof
 from databroker_extractor.common.databroker import activate_beamline_db
 
 
-def extractor_cli():
-    args, save_files = cl.parse_command_line()
+def extractor_cli(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'sync':
+        return sync_cli(argv[1:])
+    if argv and argv[0] == 'search':
+        return search_cli(argv[1:])
+
+    args, save_files = cl.parse_command_line(argv)
+    if args.profile:
+        c_prof.enable()
+    if args.metrics_cache:
+        c_metrics.enable(path=None if args.metrics_cache is True else args.metrics_cache)
 
-    config_dict = cl.read_config(beamline=args.beamline)
+    plot_ids = cl.parse_scan_ids(args.plot_ids) if args.plot_ids is not None else None
+    save_ids = None
+    if save_files:
+        save_ids = cl.parse_scan_ids(args.save_ids) if args.save_ids is not None else cl.parse_range_ids(args.range_ids)
 
-    db = activate_beamline_db(args.beamline)
+    store_size = args.store_size * 1024 ** 3 if args.store_size else None
+    beamlines = []
+    if cl.has_beamline_ids(plot_ids) or cl.has_beamline_ids(save_ids):
+        # Several beamlines: the scans are qualified as 'BEAMLINE:scan_id' and read from their databases concurrently.
+        plot_ids = cl.parse_beamline_scan_ids(plot_ids, args.beamline) if plot_ids is not None else None
+        save_ids = cl.parse_beamline_scan_ids(save_ids, args.beamline) if save_ids is not None else None
+        scan_ids = (plot_ids or []) + (save_ids or [])
+        beamlines = list(OrderedDict.fromkeys(c_db.split_beamline_id(scan_id)[0] for scan_id in scan_ids))
+        db = {bl: activate_beamline_db(bl, local_store=args.local_store,
+                                       store_dir=os.path.join(args.store_dir, bl.lower()) if args.store_dir else None,
+                                       store_size=store_size, offline=args.offline) for bl in beamlines}
+    else:
+        db = activate_beamline_db(args.beamline, local_store=args.local_store, store_dir=args.store_dir,
+                                  store_size=store_size, offline=args.offline)
 
-    x_label = args.x_label if args.x_label else cl.get_beamline_labels(config_dict=config_dict, label='x_label')
-    y_label = args.y_label if args.y_label else cl.get_beamline_labels(config_dict=config_dict, label='y_label')
-    x_units = args.x_units if args.x_units else cl.get_beamline_units(config_dict=config_dict, units='x_units')
-    y_units = args.y_units if args.y_units else cl.get_beamline_units(config_dict=config_dict, units='y_units')
+    config_dict = cl.read_config(beamline=args.beamline or beamlines[0])
+    if len(beamlines) > 1:
+        # Each beamline has its own default labels:
+        default_labels = {bl: cl.read_config(beamline=bl)['default_labels'] for bl in beamlines}
+        x_label = args.x_label if args.x_label else {bl: labels['x_label'] for bl, labels in default_labels.items()}
+        y_label = args.y_label if args.y_label else {bl: labels['y_label'] for bl, labels in default_labels.items()}
+        x_units = args.x_units if args.x_units else {bl: labels['x_units'] for bl, labels in default_labels.items()}
+        y_units = args.y_units if args.y_units else {bl: labels['y_units'] for bl, labels in default_labels.items()}
+    else:
+        x_label = args.x_label if args.x_label else cl.get_beamline_labels(config_dict=config_dict, label='x_label')
+        y_label = args.y_label if args.y_label else cl.get_beamline_labels(config_dict=config_dict, label='y_label')
+        x_units = args.x_units if args.x_units else cl.get_beamline_units(config_dict=config_dict, units='x_units')
+        y_units = args.y_units if args.y_units else cl.get_beamline_units(config_dict=config_dict, units='y_units')
 
     plot_kwargs = {
         'timestamp': args.timestamp,
@@ -35,6 +78,15 @@ def extractor_cli():
     if args.scatter_size:
         plot_kwargs['scatter_size'] = args.scatter_size
 
+    read_kwargs = {
+        'x_label': x_label,
+        'y_label': y_label,
+        'convert_to_energy': args.convert_to_energy,
+        'material': args.material,
+        'delta_bragg': args.delta_bragg,
+        'd_spacing': args.d_spacing,
+    }
+
     save_kwargs = {
         'timestamp': args.timestamp,
         'extension': args.data_extension,
@@ -42,20 +94,73 @@ def extractor_cli():
         'index': args.hide_index_column,
     }
 
-    if args.plot_ids is not None:
-        c_plot.plot_scans(db, scan_ids=cl.parse_scan_ids(args.plot_ids), **plot_kwargs)
+    if plot_ids is not None:
+        c_plot.plot_scans(db, scan_ids=plot_ids, **plot_kwargs)
 
     if save_files:
-        if args.save_ids is not None:
-            scan_ids = cl.parse_scan_ids(args.save_ids)
-        else:
-            scan_ids = cl.parse_range_ids(args.range_ids)
-
-        print('The following scan ids will be saved: {} ({} scans)'.format(scan_ids, len(scan_ids)))
-        for scan_id in scan_ids:
-            c_plot.plot_scans(db, scan_ids=[scan_id], show=False, **plot_kwargs)
-            file_name = c_io.save_data(db, scan_id=scan_id, **save_kwargs)
-            print('    Saved {}'.format(file_name))
+        print('The following scan ids will be saved: {} ({} scans)'.format(save_ids, len(save_ids)))
+        c_db.get_headers(db, save_ids)  # resolve all the scans at once (and report missing/ambiguous ones up front)
+        c_export.export_scans(db, save_ids, read_kwargs=read_kwargs, plot_kwargs=plot_kwargs,
+                              save_kwargs=save_kwargs, jobs=max(args.jobs, len(beamlines)),
+                              consolidate=args.consolidate, stream=args.stream, page_size=args.page_size)
+
+    if args.profile:
+        c_prof.print_summary()
+        print('Saved the profiling trace to {}'.format(c_prof.save_trace(args.profile)))
+
+
+def search_cli(argv=None):
+    import databroker_extractor.common.date_time as c_dt
+
+    args, extra_args = cl.parse_search_command_line(argv)
+    db = activate_beamline_db(args.beamline, local_store=True, store_dir=args.store_dir, offline=not args.update)
+    if args.update:
+        import databroker_extractor.common.store as c_store
+
+        c_store.index_remote(db)
+
+    found = db.store.search(
+        plan_name=args.plan_name,
+        motor=args.motor,
+        field=args.field,
+        measurement=args.measurement,
+        sample=args.sample,
+        since=c_dt.parse_time(args.since) if args.since else None,
+        until=c_dt.parse_time(args.until) if args.until else None,
+        limit=args.limit,
+    )
+    for r in found:
+        print('{:>8}  {}  {}  {:<12}  {:<24}  {}'.format(
+            r['scan_id'], r['uid'], c_dt.humanize_time(r['time']), r['plan_name'] or '', ','.join(r['motors'] or []),
+            r['measurement'] or ''))
+    print('Found {} scans'.format(len(found)))
+
+    if found and (args.plot or args.save):
+        # The found scans are read through the same local store (the stored ones are not fetched again):
+        store_args = ['--local-store'] + (['--store-dir', args.store_dir] if args.store_dir else [])
+        if args.offline:
+            store_args.append('--offline')
+        return extractor_cli(['-b', args.beamline, '-p' if args.plot else '-s'] + [r['uid'] for r in found] +
+                             store_args + extra_args)
+    return found
+
+
+def sync_cli(argv=None):
+    import databroker_extractor.common.store as c_store
+
+    args = cl.parse_sync_command_line(argv)
+    db = activate_beamline_db(args.beamline, local_store=True, store_dir=args.store_dir,
+                              store_size=args.store_size * 1024 ** 3 if args.store_size else None)
+    while True:
+        since = args.since if args.since is not None else cl.get_beamline_config(args.beamline).last_sync_time
+        num_synced, last_time = c_store.sync_store(db, since=since, batch_size=args.batch_size, jobs=args.jobs)
+        if last_time is not None and last_time != since:
+            cl.update_config(args.beamline, last_sync_time=last_time)
+        args.since = None  # the next iterations continue from the saved time
+        print('Synced {} scans, last scan time: {}'.format(num_synced, last_time))
+        if not args.interval:
+            break
+        time.sleep(args.interval)
 
 
 if __name__ == '__main__':